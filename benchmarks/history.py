@@ -0,0 +1,122 @@
+"""Benchmark recording board history, reconstructing boards and replaying it.
+
+Run from the repository root:
+
+    python -m benchmarks.history [--frames 3600] [--changes 200]
+    python -m benchmarks.history --history path/to/history_dir --speed 60
+
+Without --history a recording of synthetic griefing is made first: a full
+2000x1000 board, then one diff frame per second with --changes random
+pixels each. The recording is then opened, boards are reconstructed at
+random moments and the whole stream is replayed into a full board template,
+as fast as possible or --speed times faster than recorded.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from history import BoardHistory, BoardRecorder
+from targets import Target
+from template import Template
+
+BOARD_SIZE = (2000, 1000)
+CANVAS_SIZE = 1000
+
+
+def record_synthetic(directory, frames, changes, keyframe_interval, rng):
+    """Record synthetic griefing, returns the boards at a few timestamps."""
+    width, height = BOARD_SIZE
+    board = rng.integers(0, 32, size=(height, width), dtype=np.uint8)
+    recorder = BoardRecorder(directory, keyframe_interval=keyframe_interval)
+    checkpoints = {}
+
+    start = time.perf_counter()
+    recorder.record((0, 0), board, timestamp=0.0)
+    for second in range(1, frames + 1):
+        # Diff frames are whole canvases with a mask, like live ones
+        canvas = second % (width // CANVAS_SIZE)
+        pixels = np.zeros((CANVAS_SIZE, CANVAS_SIZE), dtype=np.uint8)
+        mask = np.zeros(pixels.shape, dtype=bool)
+        ys = rng.integers(0, CANVAS_SIZE, changes)
+        xs = rng.integers(0, CANVAS_SIZE, changes)
+        pixels[ys, xs] = rng.integers(0, 32, changes, dtype=np.uint8)
+        mask[ys, xs] = True
+        recorder.record((canvas * CANVAS_SIZE, 0), pixels, mask, float(second))
+
+        area = board[:, canvas * CANVAS_SIZE : (canvas + 1) * CANVAS_SIZE]
+        area[mask] = pixels[mask]
+        if second % max(frames // 8, 1) == 0:
+            checkpoints[float(second)] = board.copy()
+    elapsed = time.perf_counter() - start
+    recorder.close()
+
+    size = sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
+    print(
+        f"record         {elapsed * 1000 / (frames + 1):8.3f}ms/frame"
+        f" {size / (frames + 1) / 1024:8.1f}KiB/frame"
+        f" {len(os.listdir(directory))} segments"
+    )
+    return checkpoints
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", help="Existing history_dir to read")
+    parser.add_argument("--frames", type=int, default=3600)
+    parser.add_argument("--changes", type=int, default=200)
+    parser.add_argument("--keyframe-interval", type=float, default=300)
+    parser.add_argument("--speed", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoints = {}
+        if args.history is None:
+            checkpoints = record_synthetic(
+                directory, args.frames, args.changes, args.keyframe_interval, rng
+            )
+        path = directory if args.history is None else args.history
+
+        start = time.perf_counter()
+        history = BoardHistory(path)
+        print(
+            f"open           {(time.perf_counter() - start) * 1000:8.3f}ms"
+            f" {len(history)} records, {len(history.keyframes)} keyframes"
+        )
+        if not len(history):
+            return
+
+        for timestamp, expected in checkpoints.items():
+            assert np.array_equal(history.board_at(timestamp), expected)
+
+        timings = []
+        for timestamp in rng.uniform(history.start, history.end, 20):
+            start = time.perf_counter()
+            history.board_at(timestamp)
+            timings.append(time.perf_counter() - start)
+        print(f"board_at       {statistics.median(timings) * 1000:8.3f}ms median")
+
+        # Replay into a template covering the whole board, like the client
+        board = history.board_at(history.end)
+        template = Template(rng.integers(0, 32, size=board.shape, dtype=np.uint8))
+        target = Target("replay", template, (0, 0), None)
+        start = time.perf_counter()
+        frames = history.replay(target.apply_frame, args.speed)
+        elapsed = time.perf_counter() - start
+        print(
+            f"replay         {elapsed:8.3f}s {frames / elapsed:10,.0f} frames/s"
+            f" {(history.end - history.start) / elapsed:10,.0f}x real time"
+        )
+        history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Benchmark the quantize / compose / diff / next pixel hot path offline.
+
+Run from the repository root:
+
+    python -m benchmarks.hotpath [--output results.json] [--compare old.json]
+
+Synthetic templates from a tiny sprite up to the full 2000x1000 board are
+placed on synthetic boards with several damage rates, and every stage of
+picking the next pixel is timed. Results are written as JSON so runs from
+different versions can be compared with --compare, which flags every stage
+that got slower by more than --threshold.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from board import CanvasLayout, compose_board
+from diff import MismatchIndex, board_region, find_mismatches
+from palette import Palette
+from planner import PlacementPlanner
+from priority import Prioritizer
+from template import Template
+
+# name -> (width, height) of the template
+SIZES = {
+    "sprite": (16, 16),
+    "small": (100, 100),
+    "medium": (500, 500),
+    "full": (2000, 1000),
+}
+DAMAGE_RATES = (0.01, 0.1, 0.5)
+LAYOUT = CanvasLayout({0: (0, 0), 1: (1000, 0)})
+
+
+def synthetic_template_image(width, height, rng):
+    # Smooth gradients plus noise, so there's a realistic number of colors
+    ys, xs = np.mgrid[:height, :width]
+    rgb = np.stack(
+        [
+            xs * 255 // max(width - 1, 1),
+            ys * 255 // max(height - 1, 1),
+            (xs + ys) % 256,
+        ],
+        axis=2,
+    )
+    rgb = rgb + rng.integers(-8, 9, size=rgb.shape)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+
+
+def synthetic_frames(template, palette, origin, damage_rate, rng):
+    """Canvas frames with the template drawn on them and damage_rate of it wrong."""
+    board = np.full((*LAYOUT.board_size[::-1], 3), 255, dtype=np.uint8)
+    width, height = template.size
+    x, y = origin
+    region = board[y : y + height, x : x + width]
+    region[:] = palette.rgb_table[template.pixels]
+
+    damaged = rng.random(template.pixels.shape) < damage_rate
+    colors = np.array(palette.colors, dtype=np.uint8)
+    region[damaged] = colors[rng.integers(len(colors), size=damaged.sum())]
+
+    canvas_width, canvas_height = LAYOUT.canvas_size
+    return {
+        tag: Image.fromarray(board[dy : dy + canvas_height, dx : dx + canvas_width])
+        for tag, (dx, dy) in LAYOUT.offsets.items()
+    }
+
+
+def measure(func, repeat):
+    # Warm up caches and lazy imports before timing
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def benchmark_case(size_name, damage_rate, repeat, rng):
+    width, height = SIZES[size_name]
+    board_width, board_height = LAYOUT.board_size
+    origin = (min(741, board_width - width), min(610, board_height - height))
+    palette = Palette()
+    image = synthetic_template_image(width, height, rng)
+
+    result = {"size": size_name, "damage_rate": damage_rate}
+    # Fresh palette every time, so the per color cache doesn't hide the cost
+    result["quantize_ms"] = measure(
+        lambda: Template.from_image(image, Palette()), repeat
+    )
+    template = Template.from_image(image, palette)
+
+    frames = synthetic_frames(template, palette, origin, damage_rate, rng)
+    # Decoding the frames into palette indices included
+    result["compose_ms"] = measure(
+        lambda: compose_board(LAYOUT, frames, palette), repeat
+    )
+    board = compose_board(LAYOUT, frames, palette)
+
+    result["diff_ms"] = measure(
+        lambda: find_mismatches(board, template, origin), repeat
+    )
+    mismatches = find_mismatches(board, template, origin)
+    result["mismatches"] = len(mismatches)
+    region = board_region(board, template, origin)
+
+    # Building the index from a full board, then applying a single pixel
+    # like a diff frame or a placement does
+    result["index_ms"] = measure(
+        lambda: MismatchIndex(template).update(0, 0, region), repeat
+    )
+    index = MismatchIndex(template)
+    index.update(0, 0, region)
+    pixel_rgb = region[:1, :1].copy()
+    result["index_pixel_ms"] = measure(lambda: index.update(0, 0, pixel_rgb), repeat)
+
+    for strategy in ("raster", "color_error"):
+        prioritizer = Prioritizer(strategy, template, palette)
+        planner = PlacementPlanner(index)
+
+        def select():
+            if strategy != "raster":
+                planner.update(
+                    mismatches, prioritizer.score(region, mismatches, time.time())
+                )
+            pixel = planner.acquire()
+            if pixel is not None:
+                planner.release(pixel, False)
+
+        result[f"select_{strategy}_ms"] = measure(select, repeat)
+
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Print stages that got slower than baseline by more than threshold."""
+    previous = {(r["size"], r["damage_rate"]): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        old = previous.get((result["size"], result["damage_rate"]))
+        if old is None:
+            continue
+        for key, value in result.items():
+            if not key.endswith("_ms") or key not in old or old[key] == 0:
+                continue
+            ratio = value / old[key]
+            if ratio > 1 + threshold:
+                regressions += 1
+                print(
+                    f"REGRESSION {result['size']} damage={result['damage_rate']} "
+                    f"{key}: {old[key]:.2f}ms -> {value:.2f}ms ({ratio:.2f}x)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=list(SIZES))
+    parser.add_argument("--damage-rates", type=float, nargs="+", default=DAMAGE_RATES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for size_name in args.sizes:
+        for damage_rate in args.damage_rates:
+            result = benchmark_case(size_name, damage_rate, args.repeat, rng)
+            results.append(result)
+            print(
+                "  ".join(
+                    (
+                        f"{key}={value:.2f}"
+                        if isinstance(value, float)
+                        else f"{key}={value}"
+                    )
+                    for key, value in result.items()
+                )
+            )
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Run main.py against the local mock r/place server and measure it.
+
+Run from the repository root:
+
+    python -m benchmarks.loadtest --accounts 50 --duration 60 --cooldown 5
+
+A config.json with the requested number of accounts is generated in a
+temporary directory, main.py runs there against benchmarks.mock_server with
+the given latency, error rate and griefing. Placements per minute come from
+the mock server, CPU time, memory and thread count are sampled from /proc
+(Linux only). Pass --json for machine-readable output.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from benchmarks.mock_server import MockPlace
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def sample_process(pid):
+    """Return (cpu seconds, rss bytes, threads) of a process, None without /proc.
+
+    Child processes are included. Memory is the proportional set size where
+    the kernel has it, so memory shared between them only counts once.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name may contain spaces, skip past it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = int(status["VmRSS"].split()[0]) * 1024
+    threads = int(status["Threads"])
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            rollup = dict(line.split(":", 1) for line in f if ":" in line)
+        rss = int(rollup["Pss"].split()[0]) * 1024
+    except (OSError, KeyError):
+        pass
+
+    for child in child_pids(pid):
+        sample = sample_process(child)
+        if sample is not None:
+            cpu_seconds += sample[0]
+            rss += sample[1]
+            threads += sample[2]
+    return cpu_seconds, rss, threads
+
+
+def child_pids(pid):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def write_config(directory, args, place, server):
+    config = {
+        "image_path": os.path.abspath(args.image),
+        "image_start_coords": list(args.origin),
+        "thread_delay": args.thread_delay,
+        "unverified_place_frequency": False,
+        "token_url": f"{place.base_url}/api/v1/access_token",
+        "query_url": f"{place.base_url}/query",
+        "websocket_url": f"ws://127.0.0.1:{server.server_port}/query",
+        "workers": {
+            f"account{i}": {
+                "password": "password",
+                "client_id": "clientid",
+                "client_secret": "clientsecret",
+                "start_coords": [0, 0],
+            }
+            for i in range(args.accounts)
+        },
+    }
+    config.update(json.loads(args.extra_config))
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+
+
+def run(args):
+    with Image.open(args.image) as im:
+        template_size = im.size
+
+    place = MockPlace(
+        canvas_count=args.canvas_count,
+        canvas_size=args.canvas_size,
+        cooldown=args.cooldown,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        grief_rate=args.grief_rate,
+        grief_region=(*args.origin, *template_size),
+        seed=args.seed,
+    )
+    server = place.serve()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory, args, place, server)
+        log_path = os.path.join(directory, "main.log")
+        command = [
+            sys.executable,
+            os.path.join(REPOSITORY, "main.py"),
+            "--processes",
+            str(args.processes),
+        ]
+        if args.profile is not None:
+            command += ["--profile", os.path.abspath(args.profile)]
+        with open(log_path, "w") as log:
+            process = subprocess.Popen(
+                command,
+                cwd=directory,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+            samples = []
+            started = time.monotonic()
+            try:
+                while time.monotonic() - started < args.duration:
+                    if process.poll() is not None:
+                        break
+                    sample = sample_process(process.pid)
+                    if sample is not None:
+                        samples.append(sample)
+                    time.sleep(1)
+            finally:
+                elapsed = time.monotonic() - started
+                process.terminate()
+                process.wait()
+
+        if process.returncode not in (0, -15) and args.show_log:
+            with open(log_path) as f:
+                print(f.read())
+
+    place.stop(server)
+
+    result = {
+        "accounts": args.accounts,
+        "processes": args.processes,
+        "duration": round(elapsed, 1),
+        "placements_per_minute": round(place.stats["placed"] * 60 / elapsed, 1),
+        **place.stats,
+    }
+    if samples:
+        result.update(
+            cpu_percent=round((samples[-1][0] - samples[0][0]) * 100 / elapsed, 1),
+            peak_rss_mb=round(max(rss for _, rss, _ in samples) / 2**20, 1),
+            max_threads=max(threads for _, _, threads in samples),
+        )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--cooldown", type=float, default=5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--grief-rate", type=float, default=1.0)
+    parser.add_argument("--image", default=os.path.join(REPOSITORY, "image.png"))
+    parser.add_argument("--origin", type=int, nargs=2, default=(741, 610))
+    parser.add_argument("--canvas-count", type=int, default=2)
+    parser.add_argument("--canvas-size", type=int, default=1000)
+    parser.add_argument("--thread-delay", type=float, default=0)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile main.py, writing PATH.prof and PATH.txt",
+    )
+    parser.add_argument(
+        "--extra-config",
+        default="{}",
+        help="JSON object merged into the generated config.json",
+    )
+    parser.add_argument("--show-log", action="store_true")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(f"{key:<24} {value}")
+
+
+if __name__ == "__main__":
+    main()
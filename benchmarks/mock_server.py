@@ -0,0 +1,484 @@
+"""A local stand-in for the r/place endpoints used by PlaceClient.
+
+It implements the token endpoint, the setPixel mutation with cooldowns, the
+configuration and canvas websocket subscriptions (full and diff frames) and
+hosts the frame PNGs, all on one port. Latency, error rate and griefing can
+be tuned to exercise the client. Run it on its own with
+
+    python -m benchmarks.mock_server [--port 8000]
+
+and point token_url, query_url and websocket_url in config.json at it, or
+let benchmarks.loadtest start it for you.
+"""
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs
+
+import numpy as np
+from PIL import Image
+
+from palette import Palette
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# How many frame PNGs are kept around for downloading
+MAX_FRAMES = 256
+
+
+class MockPlace:
+    """State of the mock canvas, accounts and request counters."""
+
+    def __init__(
+        self,
+        canvas_count=2,
+        canvas_size=1000,
+        cooldown=300,
+        latency=0.0,
+        error_rate=0.0,
+        grief_rate=0.0,
+        grief_region=None,
+        diff_interval=1.0,
+        seed=None,
+    ):
+        self.canvas_size = canvas_size
+        self.cooldown = cooldown
+        self.latency = latency
+        self.error_rate = error_rate
+        self.grief_rate = grief_rate
+        self.grief_region = grief_region
+        self.diff_interval = diff_interval
+        self.random = random.Random(seed)
+        self.palette = Palette()
+
+        # Canvases sit next to each other in a row
+        self.canvases = [
+            np.full((canvas_size, canvas_size, 3), 255, dtype=np.uint8)
+            for _ in range(canvas_count)
+        ]
+        # Per canvas list of (timestamp, x, y) changes, for diff frames
+        self.changes = [[] for _ in range(canvas_count)]
+        self.frames = {}
+        self.base_url = None
+
+        self.tokens = {}
+        self.next_available = {}
+        self.stats = {
+            "tokens": 0,
+            "placed": 0,
+            "ratelimited": 0,
+            "injected_errors": 0,
+            "full_frames": 0,
+            "diff_frames": 0,
+            "frame_downloads": 0,
+            "griefed": 0,
+        }
+
+        self._lock = threading.Lock()
+        self._clock_lock = threading.Lock()
+        self._last_timestamp = 0
+        self._frame_ids = itertools.count()
+        self._stopped = threading.Event()
+
+    def timestamp(self):
+        # Strictly increasing millisecond timestamps
+        with self._clock_lock:
+            self._last_timestamp = max(
+                int(time.time() * 1000), self._last_timestamp + 1
+            )
+            return self._last_timestamp
+
+    def configuration(self):
+        return {
+            "__typename": "ConfigurationMessageData",
+            "colorPalette": {
+                "colors": [
+                    {"hex": color_hex, "index": index}
+                    for color_hex, index in self.palette.hex_to_index.items()
+                ]
+            },
+            "canvasConfigurations": [
+                {"index": index, "dx": index * self.canvas_size, "dy": 0}
+                for index in range(len(self.canvases))
+            ],
+            "canvasWidth": self.canvas_size,
+            "canvasHeight": self.canvas_size,
+        }
+
+    def set_pixel(self, canvas_index, x, y, rgb):
+        with self._lock:
+            self.canvases[canvas_index][y, x] = rgb
+            self.changes[canvas_index].append((self.timestamp(), x, y))
+
+    def store_frame(self, im):
+        buffer = BytesIO()
+        im.save(buffer, "PNG")
+        name = next(self._frame_ids)
+        with self._lock:
+            self.frames[name] = buffer.getvalue()
+            self.frames.pop(name - MAX_FRAMES, None)
+        return f"{self.base_url}/frames/{name}.png"
+
+    def full_frame(self, canvas_index):
+        with self._lock:
+            timestamp = self.timestamp()
+            im = Image.fromarray(self.canvases[canvas_index].copy())
+        self.stats["full_frames"] += 1
+        return self.store_frame(im), timestamp
+
+    def diff_frame(self, canvas_index, since):
+        """Return (url, timestamp) of a frame with changes after since, or None."""
+        with self._lock:
+            changes = [(x, y) for ts, x, y in self.changes[canvas_index] if ts > since]
+            if not changes:
+                return None
+            timestamp = self.timestamp()
+            frame = np.zeros((self.canvas_size, self.canvas_size, 4), dtype=np.uint8)
+            for x, y in changes:
+                frame[y, x, :3] = self.canvases[canvas_index][y, x]
+                frame[y, x, 3] = 255
+        self.stats["diff_frames"] += 1
+        return self.store_frame(Image.fromarray(frame, "RGBA")), timestamp
+
+    def grief(self):
+        # Flip random pixels, inside grief_region if set
+        colors = self.palette.colors
+        while not self._stopped.wait(1 / self.grief_rate):
+            if self.grief_region is not None:
+                x0, y0, width, height = self.grief_region
+                x = x0 + self.random.randrange(width)
+                y = y0 + self.random.randrange(height)
+            else:
+                x = self.random.randrange(self.canvas_size * len(self.canvases))
+                y = self.random.randrange(self.canvas_size)
+            canvas_index, x = divmod(x, self.canvas_size)
+            if canvas_index < len(self.canvases) and y < self.canvas_size:
+                self.set_pixel(canvas_index, x, y, self.random.choice(colors))
+                self.stats["griefed"] += 1
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Start serving in background threads, returns the server."""
+        server = ThreadingHTTPServer((host, port), MockPlaceHandler)
+        server.daemon_threads = True
+        server.place = self
+        self.base_url = f"http://{host}:{server.server_port}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        if self.grief_rate > 0:
+            threading.Thread(target=self.grief, daemon=True).start()
+        return server
+
+    def stop(self, server):
+        self._stopped.set()
+        server.shutdown()
+
+
+class MockPlaceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def place(self):
+        return self.server.place
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def send_body(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate_network(self):
+        """Apply latency, return False if this request should fail."""
+        if self.place.latency:
+            time.sleep(self.place.latency)
+        if self.place.random.random() < self.place.error_rate:
+            self.place.stats["injected_errors"] += 1
+            self.send_body(503, "Service Unavailable", "text/plain")
+            return False
+        return True
+
+    def do_GET(self):
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            return self.handle_websocket()
+
+        if self.path.startswith("/frames/") and self.path.endswith(".png"):
+            if not self.simulate_network():
+                return
+            name = int(self.path[len("/frames/") : -len(".png")])
+            frame = self.place.frames.get(name)
+            if frame is None:
+                return self.send_body(404, "Frame expired", "text/plain")
+            self.place.stats["frame_downloads"] += 1
+            return self.send_body(200, frame, "image/png")
+
+        self.send_body(404, "Not found", "text/plain")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.simulate_network():
+            return
+
+        if self.path == "/api/v1/access_token":
+            return self.handle_token(parse_qs(body.decode()))
+        if self.path == "/query":
+            return self.handle_query(json.loads(body))
+        self.send_body(404, "Not found", "text/plain")
+
+    def handle_token(self, form):
+        username = form.get("username", [""])[0]
+        if not username or not form.get("password"):
+            return self.send_body(200, {"error": 401, "message": "Unauthorized"})
+
+        token = f"mock-{username}-{self.place.random.getrandbits(64):016x}"
+        self.place.tokens[token] = username
+        self.place.stats["tokens"] += 1
+        self.send_body(
+            200,
+            {
+                "access_token": token,
+                "token_type": "bearer",
+                "expires_in": 3600,
+                "scope": "*",
+            },
+        )
+
+    def handle_query(self, request):
+        token = self.headers.get("Authorization", "")[len("Bearer ") :]
+        username = self.place.tokens.get(token)
+        if username is None or request.get("operationName") != "setPixel":
+            return self.send_body(401, {"data": None, "errors": [{"message": "no"}]})
+
+        now = time.time() * 1000
+        next_available = self.place.next_available.get(username, 0)
+        if now < next_available:
+            self.place.stats["ratelimited"] += 1
+            return self.send_body(
+                200,
+                {
+                    "data": None,
+                    "errors": [
+                        {
+                            "message": "Ratelimited",
+                            "extensions": {"nextAvailablePixelTs": next_available},
+                        }
+                    ],
+                },
+            )
+
+        pixel = request["variables"]["input"]["PixelMessageData"]
+        self.place.set_pixel(
+            pixel["canvasIndex"],
+            pixel["coordinate"]["x"],
+            pixel["coordinate"]["y"],
+            self.place.palette.index_to_rgb[pixel["colorIndex"]],
+        )
+        next_available = now + self.place.cooldown * 1000
+        self.place.next_available[username] = next_available
+        self.place.stats["placed"] += 1
+        self.send_body(
+            200,
+            {
+                "data": {
+                    "act": {
+                        "data": [
+                            {
+                                "data": {
+                                    "nextAvailablePixelTimestamp": next_available,
+                                    "__typename": "GetUserCooldownResponseMessageData",
+                                }
+                            },
+                            {
+                                "data": {
+                                    "timestamp": now,
+                                    "__typename": "SetPixelResponseMessageData",
+                                }
+                            },
+                        ]
+                    }
+                }
+            },
+        )
+
+    def handle_websocket(self):
+        key = self.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.close_connection = True
+
+        WebSocketSession(self.place, self.rfile, self.wfile).run()
+
+
+class WebSocketSession:
+    """One client connection speaking the graphql-ws subscription protocol."""
+
+    def __init__(self, place, rfile, wfile):
+        self.place = place
+        self.rfile = rfile
+        self.wfile = wfile
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+        # Subscription id -> [canvas index, timestamp of the last frame sent]
+        self.subscriptions = {}
+
+    def run(self):
+        threading.Thread(target=self.push_diffs, daemon=True).start()
+        try:
+            while True:
+                message = self.receive()
+                if message is None:
+                    break
+                self.handle(json.loads(message))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._closed.set()
+
+    def handle(self, message):
+        if message["type"] == "connection_init":
+            self.send({"type": "connection_ack"})
+        elif message["type"] == "stop":
+            self.subscriptions.pop(message["id"], None)
+        elif message["type"] == "start":
+            channel = message["payload"]["variables"]["input"]["channel"]
+            if channel["category"] == "CONFIG":
+                self.send_data(message["id"], self.place.configuration())
+            else:
+                canvas_index = int(channel["tag"])
+                url, timestamp = self.place.full_frame(canvas_index)
+                self.subscriptions[message["id"]] = [canvas_index, timestamp]
+                self.send_data(
+                    message["id"],
+                    {
+                        "__typename": "FullFrameMessageData",
+                        "name": url,
+                        "timestamp": timestamp,
+                    },
+                )
+
+    def push_diffs(self):
+        while not self._closed.wait(self.place.diff_interval):
+            for subscription_id, state in list(self.subscriptions.items()):
+                canvas_index, previous = state
+                frame = self.place.diff_frame(canvas_index, previous)
+                if frame is None:
+                    continue
+                url, timestamp = frame
+                state[1] = timestamp
+                try:
+                    self.send_data(
+                        subscription_id,
+                        {
+                            "__typename": "DiffFrameMessageData",
+                            "name": url,
+                            "currentTimestamp": timestamp,
+                            "previousTimestamp": previous,
+                        },
+                    )
+                except OSError:
+                    return
+
+    def send_data(self, subscription_id, data):
+        self.send(
+            {
+                "id": subscription_id,
+                "type": "data",
+                "payload": {"data": {"subscribe": {"id": "mock", "data": data}}},
+            }
+        )
+
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, len(payload))
+        elif len(payload) < 1 << 16:
+            header = struct.pack("!BBH", 0x81, 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x81, 127, len(payload))
+        with self._send_lock:
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def receive(self):
+        """Read the next text message, None once the client closed."""
+        while True:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return None
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                (length,) = struct.unpack("!H", self.rfile.read(2))
+            elif length == 127:
+                (length,) = struct.unpack("!Q", self.rfile.read(8))
+            mask = self.rfile.read(4) if header[1] & 0x80 else bytes(4)
+            payload = bytes(
+                byte ^ mask[i % 4] for i, byte in enumerate(self.rfile.read(length))
+            )
+
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                with self._send_lock:
+                    self.wfile.write(bytes((0x8A, len(payload))) + payload)
+                    self.wfile.flush()
+            elif opcode == 0x1:
+                return payload.decode()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--canvas-count", type=int, default=2)
+    parser.add_argument("--canvas-size", type=int, default=1000)
+    parser.add_argument("--cooldown", type=float, default=300)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--grief-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    place = MockPlace(
+        args.canvas_count,
+        args.canvas_size,
+        args.cooldown,
+        args.latency,
+        args.error_rate,
+        args.grief_rate,
+    )
+    server = place.serve(port=args.port)
+    print(f"Mock r/place listening on {place.base_url}")
+    print(f'  "token_url": "{place.base_url}/api/v1/access_token",')
+    print(f'  "query_url": "{place.base_url}/query",')
+    print(f'  "websocket_url": "ws://127.0.0.1:{server.server_port}/query"')
+    try:
+        while True:
+            time.sleep(10)
+            logging.info(f"Mock r/place stats: {place.stats}")
+    except KeyboardInterrupt:
+        place.stop(server)
+
+
+if __name__ == "__main__":
+    main()
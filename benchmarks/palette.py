@@ -0,0 +1,153 @@
+"""Compare the legacy per-pixel palette scan against the cached Palette.
+
+Run from the repository root:
+
+    python -m benchmarks.palette [image_path]
+
+Without an image a synthetic 256x256 gradient is used. Before timing
+anything, CIEDE2000 is checked against published test data and the
+vectorized Floyd-Steinberg against a plain pixel by pixel one.
+"""
+
+import math
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from color import ciede2000
+from dither import DITHERING, floyd_steinberg
+from palette import MATCHING, Palette
+
+# (Lab 1, Lab 2, difference) pairs from the CIEDE2000 test data of Sharma,
+# Wu and Dalal, covering the hue mean wrapping around 360 degrees
+CIEDE2000_PAIRS = [
+    ((50, 2.6772, -79.7751), (50, 0, -82.7485), 2.0425),
+    ((50, 0, 0), (50, -1, 2), 2.3669),
+    ((50, 2.49, -0.001), (50, -2.49, 0.0009), 7.1792),
+    ((50, 2.49, -0.001), (50, -2.49, 0.001), 7.1792),
+    ((50, 2.49, -0.001), (50, -2.49, 0.0011), 7.2195),
+    ((50, 2.5, 0), (73, 25, -18), 27.1492),
+]
+
+
+def legacy_closest_color(rgb_colors_array, target_rgb):
+    # Copy of the pre-Palette PlaceClient.closest_color, kept as the baseline
+    r, g, b = target_rgb
+    color_diffs = []
+    for color in rgb_colors_array:
+        cr, cg, cb = color
+        color_diff = math.sqrt((r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2)
+        color_diffs.append((color_diff, color))
+    return min(color_diffs)[1]
+
+
+def sequential_floyd_steinberg(rgb, palette, matching="rgb", opaque=None):
+    # Plain pixel by pixel Floyd-Steinberg, adding up the errors in the same
+    # order as dither.floyd_steinberg so float32 rounding matches too
+    height, width = rgb.shape[:2]
+    if opaque is None:
+        opaque = np.ones((height, width), dtype=bool)
+    colors = np.array(palette.colors, dtype=np.float32)
+    errors = np.zeros((height + 1, width + 2, 3), dtype=np.float32)
+    nearest = np.zeros((height, width), dtype=np.intp)
+    for y in range(height):
+        for x in range(width):
+            old = rgb[y, x].astype(np.float32)
+            old += errors[y - 1, x] * (1 / 16) if y else 0
+            old += errors[y - 1, x + 1] * (5 / 16) if y else 0
+            old += errors[y, x] * (7 / 16)
+            old += errors[y - 1, x + 2] * (3 / 16) if y else 0
+            old = np.clip(old, 0, 255)
+            nearest[y, x] = palette.nearest(old[np.newaxis], matching, exact=False)[0]
+            if opaque[y, x]:
+                errors[y, x + 1] = old - colors[nearest[y, x]]
+    return np.array(palette.indices, dtype=np.uint8)[nearest]
+
+
+def check_color_science(palette):
+    for lab1, lab2, expected in CIEDE2000_PAIRS:
+        assert round(float(ciede2000(lab1, lab2)), 4) == expected, (lab1, lab2)
+
+    rng = np.random.default_rng(0)
+    for height, width in [(1, 1), (1, 40), (30, 1), (7, 13), (30, 40)]:
+        rgb = rng.integers(256, size=(height, width, 3), dtype=np.uint8)
+        opaque = rng.random((height, width)) < 0.8
+        for matching in MATCHING:
+            for mask in (None, opaque):
+                assert np.array_equal(
+                    floyd_steinberg(rgb, palette, matching, mask),
+                    sequential_floyd_steinberg(rgb, palette, matching, mask),
+                ), (height, width, matching)
+
+
+def timed(label, pixel_count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f}s {pixel_count / elapsed:14,.0f} px/s")
+    return elapsed
+
+
+def synthetic_gradient(size=256):
+    ramp = np.arange(size, dtype=np.uint8)
+    red, green = np.meshgrid(ramp, ramp)
+    blue = (red // 2 + green // 2).astype(np.uint8)
+    return np.stack([red, green, blue], axis=2)
+
+
+def main():
+    if len(sys.argv) > 1:
+        source = sys.argv[1]
+        pixels = np.asarray(Image.open(source).convert("RGB"))
+    else:
+        source = "synthetic gradient"
+        pixels = synthetic_gradient()
+    # Repeat the template to mimic rescans over the same colors
+    pixels = np.tile(pixels, (2, 2, 1))
+    rgb_list = [tuple(p) for p in pixels.reshape(-1, 3).tolist()]
+    pixel_count = len(rgb_list)
+    print(f"{pixel_count:,} pixels from {source}")
+
+    palette = Palette()
+    for rgb in rgb_list[:: max(1, pixel_count // 5000)]:
+        assert palette.closest_rgb(rgb) == legacy_closest_color(palette.colors, rgb)
+    check_color_science(palette)
+    palette = Palette()
+
+    legacy = timed(
+        "legacy closest_color",
+        pixel_count,
+        lambda: [legacy_closest_color(palette.colors, rgb) for rgb in rgb_list],
+    )
+    cached = timed(
+        "Palette.closest_index",
+        pixel_count,
+        lambda: [palette.closest_index(rgb) for rgb in rgb_list],
+    )
+    vectorized = timed(
+        "Palette.quantize", pixel_count, lambda: palette.quantize(pixels)
+    )
+
+    print(f"speedup cached:     {legacy / cached:6.1f}x")
+    print(f"speedup vectorized: {legacy / vectorized:6.1f}x")
+
+    # Perceptual matching and dithering, after building any lookup tables
+    for matching in MATCHING:
+        palette.quantize(pixels[:1, :1], matching)
+        timed(
+            f"quantize {matching}",
+            pixel_count,
+            lambda: palette.quantize(pixels, matching),
+        )
+        for name, dither in DITHERING.items():
+            timed(
+                f"{name} {matching}",
+                pixel_count,
+                lambda: dither(pixels, palette, matching),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Simulate repairing a damaged template under every priority strategy.
+
+Run from the repository root:
+
+    python -m benchmarks.priority [--size 64] [--grief-rate 0.3] [--seed 1]
+
+A synthetic template gets a block of griefing plus scattered noise, then
+one pixel is repaired per placement while griefers keep flipping random
+pixels. For each strategy the table shows how many placements it took until
+the outline was intact, the bright middle of the priority mask was intact,
+90% of the color error was gone and the template was fully restored, plus
+how many placements a freshly griefed pixel stayed wrong on average.
+"""
+
+import argparse
+
+import numpy as np
+
+from diff import MismatchIndex
+from palette import Palette
+from planner import PlacementPlanner
+from priority import STRATEGIES, Prioritizer
+from template import TRANSPARENT, Template
+
+
+def synthetic_template(palette, size):
+    ramp = np.linspace(0, 255, size, dtype=np.uint8)
+    red, green = np.meshgrid(ramp, ramp)
+    rgb = np.stack([red, green, 255 - red // 2 - green // 2], axis=2)
+    pixels = palette.quantize(rgb)
+
+    ys, xs = np.mgrid[:size, :size]
+    center = (size - 1) / 2
+    distance = np.hypot(ys - center, xs - center)
+    pixels[distance > size / 2] = TRANSPARENT
+
+    # Brighter towards the middle
+    mask = np.clip(255 - distance * 510 / size, 0, 255).astype(np.uint8)
+    return Template(pixels), mask
+
+
+def color_error(board, template, palette):
+    target = palette.rgb_table[template.pixels].astype(np.int32)
+    error = ((target - board) ** 2).sum(axis=2)
+    error[template.pixels == TRANSPARENT] = 0
+    return error.sum()
+
+
+def simulate(strategy, template, mask, palette, grief_rate, seed, max_placements):
+    rng = np.random.default_rng(seed)
+    size = template.size[0]
+    colors = np.array(palette.colors, dtype=np.uint8)
+
+    board = palette.rgb_table[template.pixels].copy()
+    block = size // 3
+    board[block : 2 * block, block : 2 * block] = colors[
+        rng.integers(len(colors), size=(block, block))
+    ]
+    noise = rng.random((size, size)) < 0.05
+    board[noise] = colors[rng.integers(len(colors), size=noise.sum())]
+
+    prioritizer = Prioritizer(strategy, template, palette, mask)
+    index = MismatchIndex(template)
+    planner = PlacementPlanner(index, lease_time=0)
+    outline = prioritizer.outline
+    initial_error = color_error(board, template, palette)
+    important = mask >= 128
+    results = {"outline": None, "mask": None, "90% color": None, "restored": None}
+    # Pixel -> placement it was griefed at, and how long griefed pixels lasted
+    griefed = {}
+    fix_delays = []
+
+    for placement in range(1, max_placements + 1):
+        for _ in range(rng.poisson(grief_rate)):
+            y, x = rng.integers(size, size=2)
+            board[y, x] = colors[rng.integers(len(colors))]
+            griefed.setdefault(y * size + x, placement)
+
+        index.update(0, 0, palette.to_indices(board))
+        mismatches = index.mismatches()
+        scores = prioritizer.score(index.board, mismatches, placement)
+        planner.update(mismatches, scores)
+        pixel = planner.acquire()
+        if pixel is not None:
+            y, x = divmod(pixel, size)
+            board[y, x] = palette.rgb_table[template.pixels[y, x]]
+            if pixel in griefed:
+                fix_delays.append(placement - griefed.pop(pixel))
+
+        wrong = np.any(board != palette.rgb_table[template.pixels], axis=2)
+        wrong &= template.pixels != TRANSPARENT
+        if results["outline"] is None and not (wrong & outline).any():
+            results["outline"] = placement
+        if results["mask"] is None and not (wrong & important).any():
+            results["mask"] = placement
+        if (
+            results["90% color"] is None
+            and color_error(board, template, palette) <= initial_error / 10
+        ):
+            results["90% color"] = placement
+        if not wrong.any():
+            results["restored"] = placement
+            break
+
+    results["fresh fix"] = round(np.mean(fix_delays)) if fix_delays else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--grief-rate", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-placements", type=int, default=20000)
+    args = parser.parse_args()
+
+    palette = Palette()
+    template, mask = synthetic_template(palette, args.size)
+
+    columns = ["outline", "mask", "90% color", "restored", "fresh fix"]
+    print(f"{'strategy':<12}" + "".join(f" {column:>10}" for column in columns))
+    for strategy in STRATEGIES:
+        results = simulate(
+            strategy,
+            template,
+            mask,
+            palette,
+            args.grief_rate,
+            args.seed,
+            args.max_placements,
+        )
+        print(
+            f"{strategy:<12}"
+            + "".join(
+                f" {'-' if value is None else value:>10}" for value in results.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Replay a recorded canvas subscription through BoardSubscriber.
+
+Run from the repository root:
+
+    python -m benchmarks.replay
+
+ReplayConnection stands in for the websocket: it answers the subscriptions
+BoardSubscriber starts with recorded messages and checks what it sends
+back. The built in recording skips a diff frame, which has to make the
+subscriber stop and restart the canvas subscription and rebuild the canvas
+from the fresh full frame, never applying the diff that came after the gap.
+Once the connection drops the board must stop counting as ready.
+"""
+
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from board import BoardSubscriber
+from palette import Palette
+
+CANVAS_SIZE = 8
+
+
+class ReplayConnection:
+    """A websocket connection replaying recorded server messages.
+
+    responses maps a subscription id to the messages to send once it's
+    started, one list for every time it's started. Everything the client
+    sends is kept in sent. done is set once every recorded message was
+    received and the client waits for more.
+    """
+
+    def __init__(self, responses):
+        self.responses = {key: list(value) for key, value in responses.items()}
+        self.sent = []
+        self.done = threading.Event()
+        self._messages = queue.Queue()
+        self._closed = threading.Event()
+
+    def send(self, payload):
+        message = json.loads(payload)
+        self.sent.append(message)
+        if message["type"] == "start" and self.responses.get(message["id"]):
+            for data in self.responses[message["id"]].pop(0):
+                self._messages.put(
+                    {
+                        "id": message["id"],
+                        "type": "data",
+                        "payload": {
+                            "data": {"subscribe": {"id": "replay", "data": data}}
+                        },
+                    }
+                )
+
+    def recv(self):
+        while not self._closed.is_set():
+            try:
+                return json.dumps(self._messages.get(timeout=0.01))
+            except queue.Empty:
+                if not any(self.responses.values()):
+                    self.done.set()
+        raise ConnectionError("Connection closed")
+
+    def close(self):
+        self._closed.set()
+
+
+def recording(palette, rng):
+    """Return (responses, frame images by name, expected canvas) of a session.
+
+    The first subscription gets a full frame, a diff on top of it and then
+    a diff whose previousTimestamp skips a frame. The restarted one gets a
+    fresh full frame and a diff on top of that.
+    """
+    colors = np.array(palette.colors, dtype=np.uint8)
+    frames = {}
+
+    def full(name, timestamp):
+        canvas = rng.integers(len(colors), size=(CANVAS_SIZE, CANVAS_SIZE))
+        frames[name] = Image.fromarray(colors[canvas])
+        data = {"__typename": "FullFrameMessageData", "name": name}
+        return canvas, dict(data, timestamp=timestamp)
+
+    def diff(name, canvas, previous, current):
+        mask = rng.random((CANVAS_SIZE, CANVAS_SIZE)) < 0.25
+        changed = canvas.copy()
+        changed[mask] = rng.integers(len(colors), size=int(mask.sum()))
+        rgba = np.zeros((CANVAS_SIZE, CANVAS_SIZE, 4), dtype=np.uint8)
+        rgba[mask, :3] = colors[changed[mask]]
+        rgba[mask, 3] = 255
+        frames[name] = Image.fromarray(rgba, "RGBA")
+        data = {
+            "__typename": "DiffFrameMessageData",
+            "name": name,
+            "currentTimestamp": current,
+            "previousTimestamp": previous,
+        }
+        return changed, data
+
+    first, first_full = full("full-1", 1)
+    first, first_diff = diff("diff-1-2", first, 1, 2)
+    # Frame 3 got lost
+    _, gap_diff = diff("diff-3-4", first, 3, 4)
+    second, second_full = full("full-5", 5)
+    second, second_diff = diff("diff-5-6", second, 5, 6)
+
+    configuration = {
+        "__typename": "ConfigurationMessageData",
+        "canvasConfigurations": [{"index": 0, "dx": 0, "dy": 0}],
+        "canvasWidth": CANVAS_SIZE,
+        "canvasHeight": CANVAS_SIZE,
+    }
+    responses = {
+        "1": [[configuration]],
+        "2": [[first_full, first_diff, gap_diff], [second_full, second_diff]],
+    }
+    return responses, frames, second
+
+
+def main():
+    palette = Palette()
+    responses, frames, expected = recording(palette, np.random.default_rng(0))
+    connection = ReplayConnection(responses)
+    applied = []
+
+    subscriber = BoardSubscriber(
+        lambda: "token",
+        connect=lambda *args, **kwargs: connection,
+        download=frames.__getitem__,
+        on_frame=lambda offset, pixels, mask=None: applied.append(mask is None),
+        palette=palette,
+    )
+    start = time.perf_counter()
+    subscriber.start()
+    assert connection.done.wait(10), "Replay didn't finish"
+    board = subscriber.snapshot(timeout=0)
+    elapsed = time.perf_counter() - start
+
+    # Losing the connection leaves the board stale until the next full frames
+    connection.close()
+    deadline = time.monotonic() + 10
+    while subscriber.wait_ready(timeout=0) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not subscriber.wait_ready(timeout=0), "Still ready after disconnecting"
+    subscriber.stop()
+
+    sent = [(message["type"], message.get("id")) for message in connection.sent]
+    assert sent[-3:] == [("start", "2"), ("stop", "2"), ("start", "2")], sent
+    assert subscriber.resyncs == 1
+    assert subscriber.full_frames == 2
+    assert subscriber.diff_frames == 2
+    # Full, diff, then after the resync full and diff, the gap diff never
+    assert applied == [True, False, True, False], applied
+    indices = np.array(palette.indices, dtype=np.uint8)
+    assert np.array_equal(board[:CANVAS_SIZE, :CANVAS_SIZE], indices[expected])
+
+    print(
+        f"replay         {elapsed * 1000:8.3f}ms {len(applied)} frames applied,"
+        f" {subscriber.resyncs} resync"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,478 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from websocket import create_connection
+
+from metrics import metrics
+from palette import Palette
+from session import HttpClient
+
+
+class BoardCache:
+    """A board snapshot shared between worker threads.
+
+    The board is fetched again only once the snapshot is older than max_age
+    seconds. Threads asking for the board while a fetch is in flight wait
+    for it and reuse its result instead of starting their own.
+    """
+
+    def __init__(self, fetch, max_age):
+        self._fetch = fetch
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._board = None
+        self._fetched_at = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """Make the next get() fetch a fresh board."""
+        with self._lock:
+            self._board = None
+
+    def get(self, *args):
+        with self._lock:
+            if (
+                self._board is not None
+                and time.monotonic() - self._fetched_at < self.max_age
+            ):
+                self.hits += 1
+                metrics.inc("board_cache_hits_total")
+                logging.debug(
+                    "Board cache hit (%d hits, %d misses)", self.hits, self.misses
+                )
+                return self._board
+
+            self.misses += 1
+            metrics.inc("board_cache_misses_total")
+            fetch_start = time.monotonic()
+            self._board = self._fetch(*args)
+            self._fetched_at = time.monotonic()
+            metrics.observe("board_fetch_seconds", self._fetched_at - fetch_start)
+            logging.info(
+                f"Board cache refreshed ({self.hits} hits, {self.misses} misses)"
+            )
+            return self._board
+
+
+WEBSOCKET_URL = "wss://gql-realtime-2.reddit.com/query"
+WEBSOCKET_ORIGIN = "https://hot-potato.reddit.com"
+
+CONFIGURATION_QUERY = "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+REPLACE_QUERY = "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+
+
+class CanvasLayout:
+    """Where every canvas sits on the board.
+
+    offsets maps a canvas tag to the (x, y) board coordinates of its top
+    left corner, all canvases are canvas_size pixels big.
+    """
+
+    def __init__(self, offsets, canvas_size=(1000, 1000)):
+        self.offsets = dict(offsets)
+        self.canvas_size = tuple(canvas_size)
+
+    @classmethod
+    def from_configuration(cls, data):
+        return cls(
+            {
+                canvas["index"]: (canvas["dx"], canvas["dy"])
+                for canvas in data["canvasConfigurations"]
+            },
+            (data["canvasWidth"], data["canvasHeight"]),
+        )
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, CanvasLayout)
+            and self.offsets == other.offsets
+            and self.canvas_size == other.canvas_size
+        )
+
+    @property
+    def board_size(self):
+        canvas_width, canvas_height = self.canvas_size
+        return (
+            max(dx for dx, _ in self.offsets.values()) + canvas_width,
+            max(dy for _, dy in self.offsets.values()) + canvas_height,
+        )
+
+    def overlapping(self, region=None):
+        """Return the tags of all canvases intersecting an (x, y, width, height) region.
+
+        Every canvas is returned when region is None.
+        """
+        if region is None:
+            return list(self.offsets)
+        x, y, width, height = region
+        canvas_width, canvas_height = self.canvas_size
+        return [
+            tag
+            for tag, (dx, dy) in self.offsets.items()
+            if dx < x + width
+            and x < dx + canvas_width
+            and dy < y + height
+            and y < dy + canvas_height
+        ]
+
+    def locate(self, x, y):
+        """Convert board coordinates to (canvas tag, x, y) on that canvas."""
+        canvas_width, canvas_height = self.canvas_size
+        for tag, (dx, dy) in self.offsets.items():
+            if dx <= x < dx + canvas_width and dy <= y < dy + canvas_height:
+                return tag, x - dx, y - dy
+        raise ValueError(f"({x}, {y}) is not on any canvas")
+
+
+# Layout of the board before the configuration has been received
+DEFAULT_LAYOUT = CanvasLayout({0: (0, 0), 1: (1000, 0)})
+
+# Pooled connections with a timeout for the default frame downloads
+DOWNLOAD_HTTP = HttpClient()
+
+
+def connection_init_message(access_token):
+    return json.dumps(
+        {
+            "type": "connection_init",
+            "payload": {"Authorization": "Bearer " + access_token},
+        }
+    )
+
+
+def configuration_start_message(subscription_id):
+    return json.dumps(
+        {
+            "id": subscription_id,
+            "type": "start",
+            "payload": {
+                "variables": {
+                    "input": {
+                        "channel": {
+                            "teamOwner": "AFD2022",
+                            "category": "CONFIG",
+                        }
+                    }
+                },
+                "extensions": {},
+                "operationName": "configuration",
+                "query": CONFIGURATION_QUERY,
+            },
+        }
+    )
+
+
+def canvas_start_message(subscription_id, canvas_tag):
+    return json.dumps(
+        {
+            "id": subscription_id,
+            "type": "start",
+            "payload": {
+                "variables": {
+                    "input": {
+                        "channel": {
+                            "teamOwner": "AFD2022",
+                            "category": "CANVAS",
+                            "tag": str(canvas_tag),
+                        }
+                    }
+                },
+                "extensions": {},
+                "operationName": "replace",
+                "query": REPLACE_QUERY,
+            },
+        }
+    )
+
+
+def stop_message(subscription_id):
+    return json.dumps({"id": subscription_id, "type": "stop"})
+
+
+def canvas_subscription_id(tag):
+    # Subscription id "1" is taken by the configuration
+    return str(2 + int(tag))
+
+
+def download_frame(url):
+    # Callers with an HttpClient of their own pass their own download instead
+    return Image.open(BytesIO(DOWNLOAD_HTTP.get(url, "frame").content))
+
+
+def decode_frame(frame, palette):
+    """Convert a frame image into palette indices and a mask of its set pixels.
+
+    Pixels of diff frames that didn't change are transparent. Only the set
+    pixels are converted, the others are left at 0.
+    """
+    rgba = np.asarray(frame.convert("RGBA"))
+    mask = rgba[..., 3] > 0
+    if mask.all():
+        return palette.to_indices(rgba), mask
+    indices = np.zeros(mask.shape, dtype=np.uint8)
+    indices[mask] = palette.to_indices(rgba[mask])
+    return indices, mask
+
+
+def paste(board, offset, pixels, mask=None):
+    """Copy palette indices onto a board at offset, clipped to the board."""
+    x, y = offset
+    height = min(pixels.shape[0], board.shape[0] - y)
+    width = min(pixels.shape[1], board.shape[1] - x)
+    area = board[y : y + height, x : x + width]
+    if mask is None:
+        area[:] = pixels[:height, :width]
+    else:
+        mask = mask[:height, :width]
+        area[mask] = pixels[:height, :width][mask]
+
+
+def compose_board(layout, frames, palette):
+    """Combine canvas tag -> frame images into one board of palette indices.
+
+    The board is a (height, width) uint8 array, one byte per pixel.
+    """
+    width, height = layout.board_size
+    board = np.zeros((height, width), dtype=np.uint8)
+    for tag, frame in frames.items():
+        paste(board, layout.offsets[tag], decode_frame(frame, palette)[0])
+    return board
+
+
+def download_board(
+    access_token, region=None, download=download_frame, url=WEBSOCKET_URL, palette=None
+):
+    """Download the board once and return it with its canvas layout.
+
+    The board is an array of palette indices, see compose_board. Only
+    canvases overlapping region, an (x, y, width, height) rectangle in
+    board coordinates, are downloaded, the rest of the board is left at 0.
+    """
+    if palette is None:
+        palette = Palette()
+    ws = create_connection(url, origin=WEBSOCKET_ORIGIN)
+    try:
+        ws.send(connection_init_message(access_token))
+        ws.send(configuration_start_message("1"))
+
+        layout = None
+        while layout is None:
+            message = json.loads(ws.recv())
+            if message["type"] == "data" and message["id"] == "1":
+                layout = CanvasLayout.from_configuration(
+                    message["payload"]["data"]["subscribe"]["data"]
+                )
+        ws.send(stop_message("1"))
+
+        # Subscription id -> canvas tag
+        pending = {
+            canvas_subscription_id(tag): tag for tag in layout.overlapping(region)
+        }
+        for subscription_id, tag in pending.items():
+            ws.send(canvas_start_message(subscription_id, tag))
+
+        frame_urls = {}
+        while pending:
+            message = json.loads(ws.recv())
+            if message["type"] != "data" or message["id"] not in pending:
+                continue
+            data = message["payload"]["data"]["subscribe"]["data"]
+            if data["__typename"] == "FullFrameMessageData":
+                frame_urls[pending.pop(message["id"])] = data["name"]
+                ws.send(stop_message(message["id"]))
+    finally:
+        ws.close()
+
+    frames = {}
+    if frame_urls:
+        with ThreadPoolExecutor(max_workers=len(frame_urls)) as executor:
+            frames = dict(zip(frame_urls, executor.map(download, frame_urls.values())))
+    board = compose_board(layout, frames, palette)
+
+    logging.info(f"Downloaded canvases {list(frame_urls)} of the board")
+    return board, layout
+
+
+class BoardSubscriber:
+    """Keeps the canvas subscriptions open and maintains an up to date board.
+
+    The configuration subscription tells which canvases exist, only those
+    overlapping region (or all of them, if it's None) are subscribed to.
+    Full frames replace a whole canvas, diff frames are pasted over it. Diff
+    frames carry the timestamp of the frame they apply on top of; when that
+    doesn't match the last frame we applied, some diffs were missed, so the
+    canvas subscription is restarted to get a fresh full frame.
+
+    The board is kept as a (height, width) array of palette indices, one
+    byte per pixel, updated in place. connect and download default to the
+    real websocket and HTTP clients and can be swapped for local stand-ins
+    that replay recorded frames. on_frame, if given, is called with the board
+    offset, palette indices and mask (None for full frames) of every frame
+    applied.
+    """
+
+    def __init__(
+        self,
+        get_access_token,
+        region=None,
+        url=WEBSOCKET_URL,
+        connect=create_connection,
+        download=download_frame,
+        reconnect_delay=5,
+        receive_timeout=60,
+        on_frame=None,
+        palette=None,
+    ):
+        self._get_access_token = get_access_token
+        self.region = region
+        self.url = url
+        self._connect = connect
+        self._download = download
+        self.reconnect_delay = reconnect_delay
+        self.receive_timeout = receive_timeout
+        self._on_frame = on_frame
+        self.palette = Palette() if palette is None else palette
+
+        self.layout = DEFAULT_LAYOUT
+        width, height = self.layout.board_size
+        self._board = np.zeros((height, width), dtype=np.uint8)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._ws = None
+        self._thread = None
+
+        # Subscription id -> canvas tag
+        self._subscriptions = {}
+        # Canvas tag -> timestamp of the last frame applied to it
+        self._timestamps = {}
+
+        self.full_frames = 0
+        self.diff_frames = 0
+        self.resyncs = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._ws is not None:
+            self._ws.close()
+
+    def wait_ready(self, timeout=None):
+        """Wait for every subscribed canvas to receive its first full frame."""
+        return self._ready.wait(timeout)
+
+    def snapshot(self, timeout=None):
+        """Return a copy of the current board.
+
+        Blocks until every subscribed canvas received its first full frame,
+        returns None if that doesn't happen within timeout seconds.
+        """
+        if not self._ready.wait(timeout):
+            return None
+        with self._lock:
+            return self._board.copy()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                logging.warning(
+                    f"Board subscription lost ({e!r}), reconnecting in {self.reconnect_delay} seconds"
+                )
+            # The board goes stale until the next full frames, let users
+            # fetch it some other way meanwhile
+            self._ready.clear()
+            self._subscriptions.clear()
+            self._timestamps.clear()
+            self._stopped.wait(self.reconnect_delay)
+
+    def _listen(self):
+        self._ws = self._connect(
+            self.url, origin=WEBSOCKET_ORIGIN, timeout=self.receive_timeout
+        )
+        try:
+            self._ws.send(connection_init_message(self._get_access_token()))
+            self._ws.send(configuration_start_message("1"))
+
+            while not self._stopped.is_set():
+                message = json.loads(self._ws.recv())
+                if message["type"] == "data":
+                    data = message["payload"]["data"]["subscribe"]["data"]
+                    if message["id"] == "1":
+                        self._handle_configuration(data)
+                    elif message["id"] in self._subscriptions:
+                        self._handle_frame(message["id"], data)
+                elif message["type"] == "error":
+                    raise RuntimeError(f"Subscription error: {message}")
+        finally:
+            self._ws.close()
+
+    def _handle_configuration(self, data):
+        layout = CanvasLayout.from_configuration(data)
+        if layout != self.layout:
+            logging.info(f"Canvas layout changed: {layout.offsets}")
+            with self._lock:
+                width, height = layout.board_size
+                board = np.zeros((height, width), dtype=np.uint8)
+                paste(board, (0, 0), self._board)
+                self._board = board
+                self.layout = layout
+
+        for tag in self.layout.overlapping(self.region):
+            subscription_id = canvas_subscription_id(tag)
+            if subscription_id not in self._subscriptions:
+                self._subscriptions[subscription_id] = tag
+                self._ws.send(canvas_start_message(subscription_id, tag))
+
+    def _handle_frame(self, subscription_id, data):
+        tag = self._subscriptions[subscription_id]
+        offset = self.layout.offsets[tag]
+
+        if data["__typename"] == "FullFrameMessageData":
+            pixels, _ = decode_frame(self._download(data["name"]), self.palette)
+            with self._lock:
+                paste(self._board, offset, pixels)
+            if self._on_frame is not None:
+                self._on_frame(offset, pixels)
+            self._timestamps[tag] = data["timestamp"]
+            self.full_frames += 1
+            metrics.inc("board_frames_total", kind="full")
+            logging.debug("Applied full frame for canvas %s", tag)
+            if len(self._timestamps) == len(self._subscriptions):
+                self._ready.set()
+
+        elif data["__typename"] == "DiffFrameMessageData":
+            if tag not in self._timestamps:
+                # Still waiting for the full frame after a resync
+                return
+            if self._timestamps[tag] != data["previousTimestamp"]:
+                logging.info(f"Missed diff frames for canvas {tag}, resyncing")
+                self.resyncs += 1
+                metrics.inc("board_resyncs_total")
+                del self._timestamps[tag]
+                self._ws.send(stop_message(subscription_id))
+                self._ws.send(canvas_start_message(subscription_id, tag))
+                return
+
+            pixels, mask = decode_frame(self._download(data["name"]), self.palette)
+            with self._lock:
+                paste(self._board, offset, pixels, mask)
+            if self._on_frame is not None:
+                self._on_frame(offset, pixels, mask)
+            self._timestamps[tag] = data["currentTimestamp"]
+            self.diff_frames += 1
+            metrics.inc("board_frames_total", kind="diff")
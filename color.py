@@ -0,0 +1,97 @@
+import numpy as np
+
+# Linear sRGB -> CIE XYZ, and the D65 white point it's relative to
+SRGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+
+def srgb_to_linear(srgb):
+    srgb = np.asarray(srgb, dtype=np.float64) / 255
+    return np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+
+
+# Whole sRGB values are common enough to look up instead
+SRGB_LINEAR_TABLE = srgb_to_linear(np.arange(256))
+
+
+def srgb_to_lab(rgb):
+    """Convert an (..., 3) array of 0-255 sRGB values to CIELAB."""
+    rgb = np.asarray(rgb)
+    if np.issubdtype(rgb.dtype, np.integer):
+        linear = SRGB_LINEAR_TABLE[rgb]
+    else:
+        linear = srgb_to_linear(rgb)
+    xyz = linear @ SRGB_TO_XYZ.T / WHITE_D65
+
+    delta = 6 / 29
+    f = np.where(xyz > delta**3, np.cbrt(xyz), xyz / (3 * delta**2) + 4 / 29)
+    return np.stack(
+        [
+            116 * f[..., 1] - 16,
+            500 * (f[..., 0] - f[..., 1]),
+            200 * (f[..., 1] - f[..., 2]),
+        ],
+        axis=-1,
+    )
+
+
+def ciede2000(lab1, lab2):
+    """CIEDE2000 color difference between broadcastable (..., 3) CIELAB arrays."""
+    L1, a1, b1 = np.moveaxis(np.asarray(lab1, dtype=np.float64), -1, 0)
+    L2, a2, b2 = np.moveaxis(np.asarray(lab2, dtype=np.float64), -1, 0)
+
+    # Rescale a* so neutral colors get their chroma right
+    C_bar7 = ((np.hypot(a1, b1) + np.hypot(a2, b2)) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(C_bar7 / (C_bar7 + 25.0**7)))
+    C1 = np.hypot((1 + G) * a1, b1)
+    C2 = np.hypot((1 + G) * a2, b2)
+    h1 = np.degrees(np.arctan2(b1, (1 + G) * a1)) % 360
+    h2 = np.degrees(np.arctan2(b2, (1 + G) * a2)) % 360
+
+    # Differences, the hue one taking the short way around the circle
+    chromatic = (C1 * C2) != 0
+    dL = L2 - L1
+    dC = C2 - C1
+    dh = h2 - h1
+    dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh))
+    dh = np.where(chromatic, dh, 0)
+    dH = 2 * np.sqrt(C1 * C2) * np.sin(np.radians(dh / 2))
+
+    # Means, again with the hue one going the short way
+    L_mean = (L1 + L2) / 2
+    C_mean = (C1 + C2) / 2
+    h_sum = h1 + h2
+    h_mean = np.where(
+        np.abs(h1 - h2) <= 180,
+        h_sum / 2,
+        np.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2),
+    )
+    h_mean = np.where(chromatic, h_mean, h_sum)
+
+    T = (
+        1
+        - 0.17 * np.cos(np.radians(h_mean - 30))
+        + 0.24 * np.cos(np.radians(2 * h_mean))
+        + 0.32 * np.cos(np.radians(3 * h_mean + 6))
+        - 0.20 * np.cos(np.radians(4 * h_mean - 63))
+    )
+    rotation = 30 * np.exp(-(((h_mean - 275) / 25) ** 2))
+    C_mean7 = C_mean**7
+    R_T = -2 * np.sqrt(C_mean7 / (C_mean7 + 25.0**7)) * np.sin(np.radians(2 * rotation))
+
+    S_L = 1 + 0.015 * (L_mean - 50) ** 2 / np.sqrt(20 + (L_mean - 50) ** 2)
+    S_C = 1 + 0.045 * C_mean
+    S_H = 1 + 0.015 * C_mean * T
+
+    return np.sqrt(
+        (dL / S_L) ** 2
+        + (dC / S_C) ** 2
+        + (dH / S_H) ** 2
+        + R_T * (dC / S_C) * (dH / S_H)
+    )
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from files import atomic_write
+
+
+class CooldownState:
+    """When every account may place its next pixel, kept on disk across restarts.
+
+    Without it a restart has every account place right away, and those still
+    on cooldown only get a rate limited response for it. Timestamps are
+    time.time() values, saved to path after every change.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        # Account name -> timestamp
+        self._times = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable cooldown state {self.path}: {e}")
+            return
+
+        # Cooldowns that ran out while we were stopped don't matter anymore
+        now = time.time()
+        self._times = {name: when for name, when in saved.items() if when > now}
+        logging.info(f"{len(self._times)} accounts are still on cooldown")
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._times.get(name, default)
+
+    def set(self, name, timestamp):
+        with self._lock:
+            self._times[name] = timestamp
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        with atomic_write(self.path) as f:
+            json.dump(self._times, f)
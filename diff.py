@@ -0,0 +1,198 @@
+import threading
+
+import numpy as np
+
+from template import TRANSPARENT
+
+
+def board_region(board, template, origin):
+    """Crop the (height, width) board of palette indices under a template.
+
+    The crop is smaller than the template when it hangs off the board.
+    """
+    x_start, y_start = origin
+    width, height = template.size
+    return board[y_start : y_start + height, x_start : x_start + width]
+
+
+def find_mismatches(board, template, origin):
+    """Find every template pixel that doesn't match the board.
+
+    board is a (height, width) array of palette indices of the whole board,
+    origin the board coordinates of the template's top left corner.
+    Returns the sorted flat template indices (y * template_width + x) of
+    all wrong pixels. Transparent pixels and pixels hanging off the board
+    are never reported.
+    """
+    region = board_region(board, template, origin)
+    region_height, region_width = region.shape
+    target = template.pixels[:region_height, :region_width]
+
+    wrong = (region != target) & (target != TRANSPARENT)
+
+    ys, xs = np.nonzero(wrong)
+    return ys * template.size[0] + xs
+
+
+def index_arrays(template):
+    """Shapes and dtypes of the arrays backing a MismatchIndex of a template."""
+    width, height = template.size
+    return {
+        "board": ((height, width), np.uint8),
+        "known": ((height, width), np.bool_),
+        "wrong": ((height, width), np.bool_),
+        "tree": ((width * height + 1,), np.int64),
+        "counters": ((2,), np.int64),
+    }
+
+
+class MismatchIndex:
+    """Incrementally maintained set of wrong template pixels.
+
+    Keeps a copy of the board under the template as palette indices, updated
+    from board frames and our own placements. Wrong pixels are tracked in a
+    Fenwick tree over the flat template indices, so counting them is O(1)
+    and finding the next one after a given pixel is O(log n). Pixels the
+    board hasn't shown yet are never considered wrong.
+    """
+
+    def __init__(self, template, arrays=None, lock=None):
+        self.template = template
+        self.width, self.height = template.size
+        self.opaque = template.pixels != TRANSPARENT
+        self._size = self.width * self.height
+
+        if arrays is None:
+            self.board = np.zeros_like(template.pixels)
+            self.known = np.zeros(self.opaque.shape, dtype=bool)
+            self.wrong = np.zeros(self.opaque.shape, dtype=bool)
+            self._tree = [0] * (self._size + 1)
+            self._counters = [0, 0]
+        else:
+            # Zeroed arrays from index_arrays(), possibly in shared memory so
+            # other processes see the same index
+            self.board = arrays["board"]
+            self.known = arrays["known"]
+            self.wrong = arrays["wrong"]
+            self._tree = arrays["tree"]
+            self._counters = arrays["counters"]
+        # Processes sharing the index need to share the lock too
+        self._lock = threading.Lock() if lock is None else lock
+
+    @property
+    def count(self):
+        return int(self._counters[0])
+
+    @property
+    def version(self):
+        """Bumped on every change, so users can tell whether to recompute."""
+        return int(self._counters[1])
+
+    def update(self, x, y, pixels, mask=None):
+        """Apply board pixels at template coordinates (x, y).
+
+        pixels is a (height, width) array of palette indices that lies inside
+        the template, mask optionally limits the update to some of its pixels.
+        """
+        height, width = pixels.shape
+        area = np.s_[y : y + height, x : x + width]
+        if mask is None:
+            mask = np.ones((height, width), dtype=bool)
+
+        with self._lock:
+            self.board[area][mask] = pixels[mask]
+            self.known[area] |= mask
+            wrong = self.board[area] != self.template.pixels[area]
+            wrong &= self.opaque[area] & self.known[area]
+            self._apply(area, wrong)
+
+    def mark(self, pixel, color_index):
+        """Record that the board now shows a color at a flat template index."""
+        y, x = divmod(pixel, self.width)
+        # One pixel at a time, skip the numpy machinery of update()
+        with self._lock:
+            self.board[y, x] = color_index
+            self.known[y, x] = True
+            wrong = (
+                bool(self.opaque[y, x]) and color_index != self.template.pixels[y, x]
+            )
+            if wrong == self.wrong[y, x]:
+                return
+            self.wrong[y, x] = wrong
+            self._add(pixel, 1 if wrong else -1)
+            self._counters[0] += 1 if wrong else -1
+            self._counters[1] += 1
+
+    def _apply(self, area, wrong):
+        # flatnonzero is an order of magnitude faster than 2d nonzero
+        ys, xs = np.divmod(np.flatnonzero(wrong != self.wrong[area]), wrong.shape[1])
+        if len(ys) == 0:
+            return
+        self.wrong[area] = wrong
+
+        if len(ys) > self._size // 64:
+            self._rebuild()
+        else:
+            # Positions are relative to the area, make them flat template indices
+            rows = np.arange(self.height)[area[0]]
+            columns = np.arange(self.width)[area[1]]
+            for y, x in zip(rows[ys].tolist(), columns[xs].tolist()):
+                self._add(
+                    y * self.width + x, 1 if wrong[y - rows[0], x - columns[0]] else -1
+                )
+        self._counters[0] = self._prefix(self._size)
+        self._counters[1] += 1
+
+    def _rebuild(self):
+        # tree[i] holds the sum of the lowbit(i) values ending at i
+        prefix = np.concatenate(([0], np.cumsum(self.wrong.reshape(-1))))
+        positions = np.arange(1, self._size + 1)
+        tree = prefix[positions] - prefix[positions - (positions & -positions)]
+        if isinstance(self._tree, list):
+            self._tree = [0] + tree.tolist()
+        else:
+            self._tree[1:] = tree
+
+    def _add(self, pixel, delta):
+        i = pixel + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i):
+        # Number of wrong pixels among the first i flat indices
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _find(self, k):
+        # Flat index of the k-th wrong pixel, counting from 1
+        position = 0
+        step = 1 << self._size.bit_length()
+        while step:
+            if position + step <= self._size and self._tree[position + step] < k:
+                position += step
+                k -= self._tree[position]
+            step >>= 1
+        return position
+
+    def is_wrong(self, pixel):
+        return bool(self.wrong.flat[pixel])
+
+    def next_after(self, pixel):
+        """Return the first wrong pixel after the given one, wrapping around.
+
+        Returns None when nothing is wrong.
+        """
+        with self._lock:
+            if self.count == 0:
+                return None
+            before = self._prefix(min(pixel + 1, self._size)) if pixel >= 0 else 0
+            return self._find(before + 1 if before < self.count else 1)
+
+    def mismatches(self):
+        """All wrong pixels as sorted flat template indices."""
+        with self._lock:
+            return np.flatnonzero(self.wrong)
@@ -0,0 +1,73 @@
+import numpy as np
+
+# 4x4 Bayer matrix, as thresholds spread evenly over [-0.5, 0.5)
+BAYER_4 = (
+    np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) + 0.5
+) / 16 - 0.5
+
+# How far ordered dithering pushes colors, roughly the distance between
+# neighbouring palette colors
+ORDERED_SPREAD = 48
+
+
+def ordered(rgb, palette, matching="rgb", opaque=None):
+    """Ordered (Bayer) dithering of an (height, width, 3) RGB array.
+
+    Returns the palette indices, fully vectorized.
+    """
+    height, width = rgb.shape[:2]
+    threshold = np.tile(BAYER_4, (height // 4 + 1, width // 4 + 1))[:height, :width]
+    shifted = rgb + threshold[..., np.newaxis] * ORDERED_SPREAD
+    return palette.quantize(
+        np.clip(np.rint(shifted), 0, 255).astype(np.uint8), matching
+    )
+
+
+def floyd_steinberg(rgb, palette, matching="rgb", opaque=None):
+    """Floyd-Steinberg dithering of an (height, width, 3) RGB array.
+
+    Returns the palette indices. A pixel only depends on its left neighbour
+    and the three above it, so the pixels on a line x + 2y = t don't depend
+    on each other and each such line is diffused in one vectorized step.
+    Pixels outside the opaque mask don't spread any error.
+    """
+    height, width = rgb.shape[:2]
+    if opaque is None:
+        opaque = np.ones((height, width), dtype=bool)
+
+    # Skew the image so every line x + 2y = t becomes row t: pixel (y, x)
+    # goes to (x + 2y, y). Extra rows and a column let errors spill over the
+    # edges without bounds checks.
+    lines = width + 2 * height + 1
+    ys, xs = np.mgrid[:height, :width]
+    skewed = (xs + 2 * ys, ys)
+    work = np.zeros((lines, height + 1, 3), dtype=np.float32)
+    work[skewed] = rgb
+    spreads = np.zeros((lines, height + 1), dtype=bool)
+    spreads[skewed] = opaque
+    colors = np.array(palette.colors, dtype=np.float32)
+    nearest = np.zeros((lines, height), dtype=np.intp)
+
+    for t in range(width + 2 * (height - 1)):
+        first = max(0, (t - width + 2) // 2)
+        last = min(height - 1, t // 2) + 1
+
+        old = np.clip(work[t, first:last], 0, 255)
+        # Exact matches don't matter much with the error spread anyway
+        chosen = palette.nearest(old, matching, exact=False)
+        nearest[t, first:last] = chosen
+        error = (old - colors[chosen]) * spreads[t, first:last, np.newaxis]
+
+        # Right neighbour, then the three below it, left to right
+        work[t + 1, first:last] += error * (7 / 16)
+        work[t + 1, first + 1 : last + 1] += error * (3 / 16)
+        work[t + 2, first + 1 : last + 1] += error * (5 / 16)
+        work[t + 3, first + 1 : last + 1] += error * (1 / 16)
+
+    return np.array(palette.indices, dtype=np.uint8)[nearest[skewed]]
+
+
+DITHERING = {
+    "ordered": ordered,
+    "floyd_steinberg": floyd_steinberg,
+}
@@ -0,0 +1,34 @@
+import contextlib
+import os
+import tempfile
+
+# The process' umask, os.umask can only read it by changing it, which isn't
+# safe once other threads create files
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w", permissions=0o666):
+    """Open a file to write path with, which replaces path once it's closed.
+
+    The data goes to a temporary file of its own first, so a crash, an
+    interrupted run or another thread writing the same path can't leave a
+    truncated or mixed up file behind. A new file gets permissions, minus
+    the umask.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(
+        prefix=f"{os.path.basename(path)}.", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            # mkstemp makes every file private to the user
+            os.chmod(temp_path, permissions & ~UMASK)
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,332 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from template import TRANSPARENT
+
+# Start of every segment file, records follow right after it
+SEGMENT_MAGIC = b"PLACEHS1"
+# Record header: kind, time.time() timestamp, x, y, width, height and size of
+# the zlib compressed payload following it
+RECORD = struct.Struct("<BdiiIII")
+# Payload is the (height, width) palette indices of the whole board
+KEYFRAME = 0
+# Payload is the changed pixels inside the (x, y, width, height) rectangle:
+# their flat positions in it, delta encoded as uint32, then their uint8
+# palette indices. Griefing is scattered, so this beats a cropped frame.
+DIFF = 1
+
+SEGMENT_NAME = re.compile(r"segment-(\d+)\.bin")
+
+# One entry per record, as kept in memory by BoardHistory
+RECORD_DTYPE = np.dtype(
+    [
+        ("timestamp", np.float64),
+        ("kind", np.uint8),
+        ("segment", np.int32),
+        ("position", np.int64),
+        ("x", np.int32),
+        ("y", np.int32),
+        ("width", np.int32),
+        ("height", np.int32),
+        ("size", np.int64),
+    ]
+)
+
+
+def segment_paths(directory):
+    """Segment files of a recording, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    numbered = []
+    for name in os.listdir(directory):
+        match = SEGMENT_NAME.fullmatch(name)
+        if match is not None:
+            numbered.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(numbered)]
+
+
+class BoardRecorder:
+    """Appends the board frames the client sees to segment files in directory.
+
+    Only pixels that actually changed are written, see DIFF, so downloading
+    the same board over and over costs next to nothing. Keyframes with the
+    whole board are written every keyframe_interval seconds and at the start
+    of every segment, so readers can reconstruct any moment without going
+    back to the very beginning. A new segment is started once the current
+    one reaches segment_size bytes.
+    """
+
+    def __init__(self, directory, segment_size=64 << 20, keyframe_interval=300):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.keyframe_interval = keyframe_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # The board as recorded so far, TRANSPARENT where nothing was seen yet
+        self.board = np.full((0, 0), TRANSPARENT, dtype=np.uint8)
+        # Earlier runs' segments are left alone, this one appends new ones
+        paths = segment_paths(directory)
+        self._segment = 0
+        if paths:
+            last = SEGMENT_NAME.fullmatch(os.path.basename(paths[-1]))
+            self._segment = int(last.group(1)) + 1
+        self._file = None
+        self._next_keyframe = float("-inf")
+        self._lock = threading.Lock()
+
+    def record(self, offset, pixels, mask=None, timestamp=None):
+        """Record a frame of palette indices at a board offset.
+
+        mask optionally marks which of its pixels are set, as for
+        BoardSubscriber frames.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        x, y = offset
+        height, width = pixels.shape
+
+        with self._lock:
+            self._grow(x + width, y + height)
+            area = self.board[y : y + height, x : x + width]
+            if mask is None:
+                ys, xs = np.divmod(np.flatnonzero(pixels != area), width)
+            else:
+                # Diff frames only set a few pixels, compare just those
+                ys, xs = np.divmod(np.flatnonzero(mask), width)
+                keep = pixels[ys, xs] != area[ys, xs]
+                ys, xs = ys[keep], xs[keep]
+
+            if len(ys):
+                values = pixels[ys, xs]
+                area[ys, xs] = values
+                top, left = int(ys.min()), int(xs.min())
+                crop_width = int(xs.max()) - left + 1
+                # Row major, so the positions are already sorted
+                positions = ((ys - top) * crop_width + xs - left).astype(np.uint32)
+                positions[1:] = np.diff(positions)
+                self._write(
+                    DIFF,
+                    timestamp,
+                    (x + left, y + top, crop_width, int(ys.max()) - top + 1),
+                    positions.tobytes() + values.tobytes(),
+                )
+
+            if (
+                timestamp >= self._next_keyframe
+                or self._file.tell() >= self.segment_size
+            ):
+                self._write_keyframe(timestamp)
+
+    def _grow(self, width, height):
+        if width <= self.board.shape[1] and height <= self.board.shape[0]:
+            return
+        board = np.full(
+            (max(height, self.board.shape[0]), max(width, self.board.shape[1])),
+            TRANSPARENT,
+            dtype=np.uint8,
+        )
+        board[: self.board.shape[0], : self.board.shape[1]] = self.board
+        self.board = board
+
+    def _write_keyframe(self, timestamp):
+        # Keyframes start segments, a reader can decode any segment on its own
+        if self._file is None or self._file.tell() >= self.segment_size:
+            self._start_segment()
+        height, width = self.board.shape
+        self._write(KEYFRAME, timestamp, (0, 0, width, height), self.board.tobytes())
+        self._next_keyframe = timestamp + self.keyframe_interval
+
+    def _start_segment(self):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, f"segment-{self._segment:06d}.bin")
+        self._segment += 1
+        self._file = open(path, "ab")
+        self._file.write(SEGMENT_MAGIC)
+        logging.debug(f"Recording board history to {path}")
+
+    def _write(self, kind, timestamp, rectangle, data):
+        if self._file is None:
+            self._start_segment()
+        payload = zlib.compress(data, 1)
+        self._file.write(RECORD.pack(kind, timestamp, *rectangle, len(payload)))
+        self._file.write(payload)
+        # Readers and crashes only ever see whole records up to here
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class BoardHistory:
+    """Reads a recording made by BoardRecorder.
+
+    Segments are memory mapped and only their record headers are read up
+    front, frames are decompressed when they're asked for. A record cut off
+    at the end of a segment, from a recorder that's still running or
+    crashed, is ignored.
+    """
+
+    def __init__(self, directory):
+        self._maps = []
+        records = []
+        for path in segment_paths(directory):
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size <= len(SEGMENT_MAGIC):
+                    continue
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if segment[: len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                raise ValueError(f"{path} is not a board history segment")
+
+            position = len(SEGMENT_MAGIC)
+            while position + RECORD.size <= len(segment):
+                kind, timestamp, x, y, width, height, size = RECORD.unpack_from(
+                    segment, position
+                )
+                if position + RECORD.size + size > len(segment):
+                    break
+                records.append(
+                    (
+                        timestamp,
+                        kind,
+                        len(self._maps),
+                        position,
+                        x,
+                        y,
+                        width,
+                        height,
+                        size,
+                    )
+                )
+                position += RECORD.size + size
+            self._maps.append(segment)
+
+        self.records = np.array(records, dtype=RECORD_DTYPE)
+        self.timestamps = self.records["timestamp"]
+        self.keyframes = np.flatnonzero(self.records["kind"] == KEYFRAME)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def start(self):
+        return float(self.timestamps[0]) if len(self) else None
+
+    @property
+    def end(self):
+        return float(self.timestamps[-1]) if len(self) else None
+
+    def _payload(self, number):
+        record = self.records[number]
+        start = int(record["position"]) + RECORD.size
+        return zlib.decompress(
+            self._maps[record["segment"]][start : start + int(record["size"])]
+        )
+
+    def changes(self, number):
+        """Return the rectangle, flat positions in it and palette indices of a diff."""
+        record = self.records[number]
+        data = self._payload(number)
+        count = len(data) // 5
+        positions = np.cumsum(np.frombuffer(data, dtype=np.uint32, count=count))
+        values = np.frombuffer(data, dtype=np.uint8, offset=count * 4)
+        rectangle = tuple(int(record[key]) for key in ("x", "y", "width", "height"))
+        return rectangle, positions, values
+
+    def frame(self, number):
+        """Return (kind, timestamp, offset, pixels, mask) of a record.
+
+        mask marks the pixels a diff sets, it's None for keyframes.
+        """
+        record = self.records[number]
+        kind = int(record["kind"])
+        timestamp = float(record["timestamp"])
+        if kind == KEYFRAME:
+            pixels = np.frombuffer(self._payload(number), dtype=np.uint8)
+            pixels = pixels.reshape(int(record["height"]), int(record["width"]))
+            return kind, timestamp, (0, 0), pixels, None
+
+        (x, y, width, height), positions, values = self.changes(number)
+        pixels = np.zeros((height, width), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=bool)
+        pixels.flat[positions] = values
+        mask.flat[positions] = True
+        return kind, timestamp, (x, y), pixels, mask
+
+    def board_at(self, timestamp):
+        """The board as it was at timestamp, TRANSPARENT where it wasn't known.
+
+        Starts from the last keyframe before it, so this only decodes the
+        diffs since then.
+        """
+        end = int(np.searchsorted(self.timestamps, timestamp, side="right"))
+        keyframes = self.keyframes[self.keyframes < end]
+        begin = int(keyframes[-1]) if len(keyframes) else 0
+
+        board = np.full((0, 0), TRANSPARENT, dtype=np.uint8)
+        for number in range(begin, end):
+            if self.records["kind"][number] == KEYFRAME:
+                # Later keyframes only repeat what the diffs before them said
+                if number == begin:
+                    board = self.frame(number)[3].copy()
+                continue
+            (x, y, width, height), positions, values = self.changes(number)
+            if x + width > board.shape[1] or y + height > board.shape[0]:
+                grown = np.full(
+                    (max(y + height, board.shape[0]), max(x + width, board.shape[1])),
+                    TRANSPARENT,
+                    dtype=np.uint8,
+                )
+                grown[: board.shape[0], : board.shape[1]] = board
+                board = grown
+            rows, columns = np.divmod(positions, width)
+            board[rows + y, columns + x] = values
+        return board
+
+    def replay(self, on_frame, speed=1.0, start=None, end=None):
+        """Feed the recording to on_frame(offset, pixels, mask), like BoardSubscriber.
+
+        The board at start comes first as one frame, then every change up to
+        end, speed times faster than recorded or as fast as possible for
+        None. Returns the number of frames.
+        """
+        if not len(self):
+            return 0
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+
+        board = self.board_at(start)
+        on_frame((0, 0), board, board != TRANSPARENT)
+        frames = 1
+
+        began = time.monotonic()
+        first = int(np.searchsorted(self.timestamps, start, side="right"))
+        last = int(np.searchsorted(self.timestamps, end, side="right"))
+        for number in range(first, last):
+            if self.records["kind"][number] == KEYFRAME:
+                # Keyframes only repeat what the diffs before them said
+                continue
+            _, timestamp, offset, pixels, mask = self.frame(number)
+            if speed is not None:
+                wait = (timestamp - start) / speed - (time.monotonic() - began)
+                if wait > 0:
+                    time.sleep(wait)
+            on_frame(offset, pixels, mask)
+            frames += 1
+        return frames
+
+    def close(self):
+        for segment in self._maps:
+            segment.close()
+        self._maps = []
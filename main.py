@@ -3,21 +3,39 @@
 import os
 import os.path
 import math
-import requests
 import json
 import time
+import functools
 import threading
 import logging
+import signal
 import colorama
 import argparse
 from io import BytesIO
-from websocket import create_connection
-from requests.auth import HTTPBasicAuth
-from PIL import ImageColor
 from PIL import Image, UnidentifiedImageError
-import random
-
-from mappings import color_map, name_map
+import numpy as np
+
+from board import (
+    DEFAULT_LAYOUT,
+    WEBSOCKET_URL,
+    BoardCache,
+    BoardSubscriber,
+    download_board,
+)
+from cooldowns import CooldownState
+from history import BoardRecorder
+from mappings import name_map
+from metrics import metrics
+from palette import Palette
+from priority import Prioritizer, default_mask_path, load_priority_mask
+from profiling import Profiler
+from scheduler import Scheduler
+from session import HttpClient
+from simulate import simulate
+from targets import Target
+from template import TRANSPARENT, Template, composite
+from tokens import TokenManager
+from verify import PlacementVerifier
 
 # Option remains for legacy usage
 # equal to running
@@ -29,9 +47,6 @@ class PlaceClient:
     def __init__(self):
         # Data
         self.json_data = self.get_json_data()
-        self.pixel_x_start: int = self.json_data["image_start_coords"][0]
-        self.pixel_y_start: int = self.json_data["image_start_coords"][1]
-
         # In seconds
         self.delay_between_launches = (
             self.json_data["thread_delay"]
@@ -39,33 +54,126 @@ class PlaceClient:
             else 3
         )
 
+        # Number of threads running due workers, independent of the worker count
+        self.scheduler_threads = self.json_data.get("scheduler_threads", 8)
+
+        # In seconds, how long a fetched board is reused by all workers
+        self.board_max_age = self.json_data.get("board_max_age", 10)
+
         self.unverified_place_frequency = (
             self.json_data["unverified_place_frequency"]
             if self.json_data["unverified_place_frequency"] is not None
             else False
         )
 
+        # Where the quantized template and tokens are kept between runs
+        self.cache_dir = self.json_data.get("cache_dir", ".cache")
+
+        # Reddit endpoints, can be pointed at a local mock server for testing
+        self.token_url = self.json_data.get(
+            "token_url", "https://ssl.reddit.com/api/v1/access_token"
+        )
+        self.query_url = self.json_data.get(
+            "query_url", "https://gql-realtime-2.reddit.com/query"
+        )
+        self.websocket_url = self.json_data.get("websocket_url", WEBSOCKET_URL)
+
+        # Opt-in metrics export
+        if self.json_data.get("metrics_port") is not None:
+            metrics.serve(self.json_data["metrics_port"])
+        if self.json_data.get("metrics_file") is not None:
+            metrics.dump_periodically(
+                self.json_data["metrics_file"],
+                self.json_data.get("metrics_interval", 60),
+            )
+
+        # Shared connection pool for all HTTP requests
+        self.http = HttpClient(
+            self.json_data.get("http_pool_size", 16),
+            self.json_data.get("http_timeout", 10),
+        )
+
         # Color palette
-        self.rgb_colors_array = self.generate_rgb_colors_array()
+        self.palette = Palette()
+
+        # Board snapshot shared by all workers
+        self.board_cache = BoardCache(self.get_board, self.board_max_age)
+        self.live_board = self.json_data.get("live_board", True)
+        self.board_subscriber = None
+        self.canvas_layout = DEFAULT_LAYOUT
+        # Opt-in recording of every board frame, for analysis and replay
+        self.board_recorder = None
+        if self.json_data.get("history_dir") is not None:
+            self.board_recorder = BoardRecorder(
+                self.json_data["history_dir"],
+                self.json_data.get("history_segment_size", 64) << 20,
+                self.json_data.get("history_keyframe_interval", 300),
+            )
+        # Watches whether placed pixels show up on the board and stay there
+        self.placement_verifier = PlacementVerifier(
+            self.json_data.get("verify_hold_time", 300),
+            self.json_data.get("verify_timeout", 60),
+        )
 
         # Auth
-        self.access_tokens = {}
-        self.access_token_expires_at_timestamp = {}
+        self.tokens = TokenManager(
+            self.http,
+            self.token_url,
+            self.json_data["workers"],
+            self.json_data.get(
+                "token_cache", os.path.join(self.cache_dir, "tokens.json")
+            ),
+            self.json_data.get("token_refresh_margin", 300),
+            self.json_data.get("token_refresh_interval", 1),
+        )
 
-        # Image information
-        self.pix = None
-        self.image_size = None
-        self.image_path = self.json_data["image_path"]
-        self.first_run_counter = 0
+        # Templates being drawn, highest compositing priority first, and the
+        # board rectangle covering all of them as (x, y, width, height)
+        self.targets = []
+        self.region = None
+        self.pixel_lease_time = self.json_data.get("pixel_lease_time", 60)
+        # Worker name -> index, new workers get new indices on reload
+        self.worker_indices = {}
+        self.next_worker_index = 0
+        # When each worker may place next, kept on disk so restarts and
+        # reloads don't waste a request on accounts still on cooldown
+        self.next_pixel_placement_time = CooldownState(
+            self.json_data.get(
+                "cooldown_state", os.path.join(self.cache_dir, "cooldowns.json")
+            )
+        )
+        # Keyed by (worker index, target name)
+        self.worker_cursors = {}
+        # Board snapshot last applied to the targets
+        self.diffed_board = None
+        self.diff_lock = threading.Lock()
+        # In seconds, how long to wait before rechecking a completed image
+        self.completed_recheck_delay = 30
+        # In seconds, how long to wait when other workers are placing every
+        # pixel that's still wrong
+        self.leased_recheck_delay = 5
+
+        # In seconds, how often config.json and the images are checked for
+        # changes, 0 only reloads on SIGHUP
+        self.reload_interval = self.json_data.get("reload_interval", 5)
+        self.reload_lock = threading.Lock()
+        # (image path, matching, dithering) -> (file signature, Template), so
+        # reloads only quantize images that changed
+        self.loaded_images = {}
+        # Watched path -> file signature when it was last loaded
+        self.watched_files = {}
+        self.scheduler = None
 
         # Initialize-functions
-        self.load_image()
+        self.watched_files = self.file_signatures()
+        try:
+            self.check_workers(self.json_data["workers"])
+            self.targets, self.region = self.load_templates()
+        except (OSError, UnidentifiedImageError, ValueError) as e:
+            logging.fatal(e)
+            exit(1)
 
     """ Utils """
-    # Convert rgb tuple to hexadecimal string
-
-    def rgb_to_hex(self, rgb):
-        return ("#%02x%02x%02x" % rgb).upper()
 
     # More verbose color indicator from a pixel color ID
     def color_id_to_name(self, color_id):
@@ -73,24 +181,6 @@ class PlaceClient:
             return "{} ({})".format(name_map[color_id], str(color_id))
         return "Invalid Color ({})".format(str(color_id))
 
-    # Find the closest rgb color from palette to a target rgb color
-
-    def closest_color(self, target_rgb):
-        r, g, b = target_rgb
-        color_diffs = []
-        for color in self.rgb_colors_array:
-            cr, cg, cb = color
-            color_diff = math.sqrt((r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2)
-            color_diffs.append((color_diff, color))
-        return min(color_diffs)[1]
-
-    # Define the color palette array
-    def generate_rgb_colors_array(self):
-        # Generate array of available rgb colors to be used
-        return [
-            ImageColor.getcolor(color_hex, "RGB") for color_hex, _i in color_map.items()
-        ]
-
     def get_json_data(self):
         if not os.path.exists("config.json"):
             exit("No config.json file found. Read the README")
@@ -102,20 +192,226 @@ class PlaceClient:
 
         return json_data
 
+    # Templates to draw, older configs have a single image instead of a list
+    def template_configs(self):
+        if "templates" in self.json_data:
+            return self.json_data["templates"]
+        config = {
+            "image_path": self.json_data["image_path"],
+            "image_start_coords": self.json_data["image_start_coords"],
+        }
+        if "priority_mask" in self.json_data:
+            config["priority_mask"] = self.json_data["priority_mask"]
+        return [config]
+
     # Read the input image.jpg file
 
-    def load_image(self):
-        # Read and load the image to draw and get its dimensions
+    def load_image(self, image_path, matching="rgb", dithering=None):
+        # Unchanged images are reused as they are
+        key = (image_path, matching, dithering)
+        signature = file_signature(image_path)
+        cached = self.loaded_images.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        # Read the image to draw, quantize it and get its dimensions
         try:
-            im = Image.open(self.image_path)
+            template = Template.load(
+                image_path, self.palette, self.cache_dir, matching, dithering
+            )
         except FileNotFoundError:
-            logging.fatal("Failed to load image")
-            exit()
+            raise FileNotFoundError(f"Failed to load image {image_path}")
         except UnidentifiedImageError:
-            logging.fatal("File found, but couldn't identify image format")
-        self.pix = im.load()
-        logging.info(f"Loaded image size: {im.size}")
-        self.image_size = im.size
+            raise UnidentifiedImageError(
+                f"File {image_path} found, but couldn't identify image format"
+            )
+        logging.info(f"Loaded image {image_path} size: {template.size}")
+        self.loaded_images[key] = (signature, template)
+        return template
+
+    def mask_path(self, config):
+        return config.get("priority_mask", default_mask_path(config["image_path"]))
+
+    def load_prioritizer(self, config, template, overwrites=None):
+        # Optional grayscale image deciding which pixels are fixed first
+        mask_path = self.mask_path(config)
+        mask = None
+        if os.path.exists(mask_path):
+            mask = load_priority_mask(mask_path, template.size)
+            logging.debug(f"Loaded priority mask {mask_path}")
+
+        strategy = self.json_data.get("priority", "raster" if mask is None else "mask")
+        return Prioritizer(
+            strategy,
+            template,
+            self.palette,
+            mask,
+            overwrites,
+            self.json_data.get("overwrite_half_life", 3600),
+        )
+
+    # Load every template and composite them, so overlapping templates don't
+    # fight over the same pixels. Targets whose pixels and settings didn't
+    # change are kept, with everything they know about the board.
+    # Returns the targets and the board region covering all of them.
+    def load_templates(self):
+        configs = self.template_configs()
+        # Templates can override how the top level setting quantizes images
+        layers = [
+            (
+                self.load_image(
+                    config["image_path"],
+                    config.get(
+                        "color_matching", self.json_data.get("color_matching", "rgb")
+                    ),
+                    config.get("dithering", self.json_data.get("dithering")),
+                ),
+                tuple(config["image_start_coords"]),
+                config.get("priority", 0),
+            )
+            for config in configs
+        ]
+        combined, (left, top), owners = composite(layers)
+        previous = {target.name: target for target in self.targets}
+
+        targets = []
+        for number, (config, (template, origin, priority)) in enumerate(
+            zip(configs, layers)
+        ):
+            # Only keep the pixels no higher priority template covers
+            x, y = origin
+            width, height = template.size
+            owned = owners[y - top : y - top + height, x - left : x - left + width]
+            template = Template(
+                np.where(owned == number, template.pixels, TRANSPARENT).astype(np.uint8)
+            )
+            name = config.get("name", config["image_path"])
+            prioritizer = self.load_prioritizer(config, template)
+            workers = config.get("workers")
+            workers = None if workers is None else set(workers)
+
+            target = previous.get(name)
+            if (
+                target is not None
+                and target.origin == origin
+                and np.array_equal(target.template.pixels, template.pixels)
+                and target.prioritizer.same_settings(prioritizer)
+            ):
+                target.priority = priority
+                target.workers = workers
+            else:
+                target = Target(
+                    name,
+                    template,
+                    origin,
+                    prioritizer,
+                    priority,
+                    workers,
+                    self.pixel_lease_time,
+                )
+            targets.append(target)
+
+        # Workers draw the highest priority template they're allowed to first
+        targets.sort(key=lambda target: -target.priority)
+        return targets, (left, top, *combined.size)
+
+    # Files whose changes trigger a reload, with their current signatures
+    def file_signatures(self):
+        paths = ["config.json"]
+        for config in self.template_configs():
+            paths += [config["image_path"], self.mask_path(config)]
+        return {path: file_signature(path) for path in paths}
+
+    def check_workers(self, workers):
+        for name, worker in workers.items():
+            if "start_coords" not in worker:
+                raise ValueError(f"You need to provide start_coords to worker '{name}'")
+
+    # Pick up changes to config.json and the images without restarting.
+    # Only templates and workers are reloaded, tokens, cooldowns and
+    # unchanged templates are kept.
+    def reload(self):
+        with self.reload_lock:
+            previous_json_data = self.json_data
+            watched_files = {}
+            try:
+                with open("config.json") as f:
+                    self.json_data = json.load(f)
+                watched_files = self.file_signatures()
+                self.check_workers(self.json_data["workers"])
+                targets, region = self.load_templates()
+            except (OSError, UnidentifiedImageError, ValueError, KeyError) as e:
+                logging.error(f"Not reloading, fix the config first: {e!r}")
+                self.json_data = previous_json_data
+                # Don't retry until something changes again, in the files of
+                # either config, like a missing image being created
+                self.watched_files = {**watched_files, **self.file_signatures()}
+                return
+            self.watched_files = watched_files
+
+            changed = [target for target in targets if target not in self.targets]
+            self.targets = targets
+            if region != self.region:
+                # Different canvases may be needed, start the board over
+                self.region = region
+                self.board_cache.invalidate()
+                if self.board_subscriber is not None:
+                    self.board_subscriber.stop()
+                    self.board_subscriber = None
+            elif self.board_subscriber is not None and changed:
+                board = self.board_subscriber.snapshot(timeout=0)
+                if board is not None:
+                    for target in changed:
+                        target.apply_frame((0, 0), board)
+            with self.diff_lock:
+                self.diffed_board = None
+
+            self.update_workers()
+            logging.info(
+                f"Reloaded config, {len(changed)} of {len(targets)} templates changed"
+            )
+
+    def reload_job(self):
+        watched_files = self.watched_files
+        if {path: file_signature(path) for path in watched_files} != watched_files:
+            self.reload()
+        return time.time() + self.reload_interval
+
+    # Start workers added to the config and stop removed ones
+    def update_workers(self):
+        workers = self.json_data["workers"]
+        self.tokens.update_workers(workers)
+        for name in list(self.worker_indices):
+            if name not in workers:
+                logging.info(f"Stopping worker {name}")
+                del self.worker_indices[name]
+
+        first_run_timestamp = time.time()
+        delay = 0
+        for name, worker in workers.items():
+            if name in self.worker_indices:
+                continue
+            index = self.next_worker_index
+            self.next_worker_index += 1
+            self.worker_indices[name] = index
+
+            # keep the token fresh in the background
+            self.scheduler.schedule(
+                f"Token {name}",
+                self.tokens.refresh_at(name),
+                functools.partial(self.tokens.refresh_job, name),
+            )
+
+            # stagger the first run of every worker by thread_delay
+            self.scheduler.schedule(
+                f"Thread #{index}",
+                max(
+                    first_run_timestamp + delay,
+                    self.next_pixel_placement_time.get(name, 0),
+                ),
+                functools.partial(self.task, index, name, worker),
+            )
+            delay += self.delay_between_launches
 
     """ Main """
     # Draw a pixel at an x, y coordinate in r/place with a specific color
@@ -124,10 +420,14 @@ class PlaceClient:
         self, access_token_in, x, y, color_index_in=18, canvas_index=0
     ):
         logging.info(
-            f"Attempting to place {self.color_id_to_name(color_index_in)} pixel at {x + (1000 * canvas_index)}, {y}"
+            "Attempting to place %s pixel at %d, %d on canvas %d",
+            self.color_id_to_name(color_index_in),
+            x,
+            y,
+            canvas_index,
         )
 
-        url = "https://gql-realtime-2.reddit.com/query"
+        url = self.query_url
 
         payload = json.dumps(
             {
@@ -153,13 +453,16 @@ class PlaceClient:
             "Content-Type": "application/json",
         }
 
-        response = requests.request("POST", url, headers=headers, data=payload)
-        logging.debug(f"Received response: {response.text}")
+        response = self.http.post(url, "place", headers=headers, data=payload)
+        # Decoding the response isn't free, only do it when it's logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Received response: %s", response.text)
 
         # There are 2 different JSON keys for responses to get the next timestamp.
         # If we don't get data, it means we've been rate limited.
         # If we do, a pixel has been successfully placed.
-        if response.json()["data"] is None:
+        placed = response.json()["data"] is not None
+        if not placed:
             waitTime = math.floor(
                 response.json()["errors"][0]["extensions"]["nextAvailablePixelTs"]
             )
@@ -186,354 +489,230 @@ class PlaceClient:
         # code.interact(local=locals())
 
         # Reddit returns time in ms and we need seconds, so divide by 1000
-        return waitTime / 1000
+        return waitTime / 1000, placed
 
     def get_board(self, access_token_in):
         logging.info("Getting board")
-        ws = create_connection(
-            "wss://gql-realtime-2.reddit.com/query",
-            origin="https://hot-potato.reddit.com",
-        )
-        ws.send(
-            json.dumps(
-                {
-                    "type": "connection_init",
-                    "payload": {"Authorization": "Bearer " + access_token_in},
-                }
-            )
-        )
-        ws.recv()
-        ws.send(
-            json.dumps(
-                {
-                    "id": "1",
-                    "type": "start",
-                    "payload": {
-                        "variables": {
-                            "input": {
-                                "channel": {
-                                    "teamOwner": "AFD2022",
-                                    "category": "CONFIG",
-                                }
-                            }
-                        },
-                        "extensions": {},
-                        "operationName": "configuration",
-                        "query": "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                    },
-                }
-            )
-        )
-        ws.recv()
-        ws.send(
-            json.dumps(
-                {
-                    "id": "2",
-                    "type": "start",
-                    "payload": {
-                        "variables": {
-                            "input": {
-                                "channel": {
-                                    "teamOwner": "AFD2022",
-                                    "category": "CANVAS",
-                                    "tag": "0",
-                                }
-                            }
-                        },
-                        "extensions": {},
-                        "operationName": "replace",
-                        "query": "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                    },
-                }
-            )
+        board, self.canvas_layout = download_board(
+            access_token_in,
+            self.region,
+            self.download_frame,
+            self.websocket_url,
+            self.palette,
         )
-
-        image_sizex = 2
-        image_sizey = 1
-
-        imgs = []
-        already_added = []
-        for i in range(0, image_sizex * image_sizey):
-            ws.send(
-                json.dumps(
-                    {
-                        "id": str(2 + i),
-                        "type": "start",
-                        "payload": {
-                            "variables": {
-                                "input": {
-                                    "channel": {
-                                        "teamOwner": "AFD2022",
-                                        "category": "CANVAS",
-                                        "tag": str(i),
-                                    }
-                                }
-                            },
-                            "extensions": {},
-                            "operationName": "replace",
-                            "query": "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                        },
-                    }
+        return board
+
+    def download_frame(self, url):
+        content = self.http.get(url, "frame").content
+        metrics.inc("board_frame_bytes_total", len(content))
+        return Image.open(BytesIO(content))
+
+    # Bring the mismatch index up to date with the board
+    def update_board(self, access_token_in):
+        if self.live_board:
+            if self.board_subscriber is None:
+                self.board_subscriber = BoardSubscriber(
+                    self.tokens.any_token,
+                    self.region,
+                    url=self.websocket_url,
+                    download=self.download_frame,
+                    on_frame=self.apply_board_frame,
+                    palette=self.palette,
                 )
+                self.board_subscriber.start()
+
+            # Frames are applied to the index as they arrive, so once the
+            # subscription is up there's nothing to fetch. Only the first
+            # connection is worth waiting for, while a lost one reconnects
+            # the board is downloaded instead.
+            timeout = 30 if self.board_subscriber.full_frames == 0 else 0
+            if self.board_subscriber.wait_ready(timeout=timeout):
+                self.canvas_layout = self.board_subscriber.layout
+                return
+            logging.warning("Live board not ready yet, downloading it instead")
+
+        board = self.board_cache.get(access_token_in)
+        with self.diff_lock:
+            # Workers share board snapshots, only apply each one once
+            if board is self.diffed_board:
+                return
+            self.diffed_board = board
+        self.apply_board_frame((0, 0), board)
+
+    # Apply a board frame at a board offset to every target
+    def apply_board_frame(self, offset, frame, mask=None):
+        if self.board_recorder is not None:
+            self.board_recorder.record(offset, frame, mask)
+        self.placement_verifier.observe(offset, frame, mask)
+        diff_start = time.perf_counter()
+        for target in self.targets:
+            target.apply_frame(offset, frame, mask)
+        metrics.observe("diff_seconds", time.perf_counter() - diff_start)
+
+    def record_progress(self, target):
+        wrong = target.index.count
+        pixel_count = target.template.pixel_count
+        metrics.set("template_pixels_wrong", wrong, template=target.name)
+        metrics.set(
+            "template_completion_ratio",
+            1 - wrong / pixel_count if pixel_count else 1,
+            template=target.name,
+        )
+        logging.debug("%s :: %d pixels left to place", target.name, wrong)
+
+    # Lease the next wrong pixel for a worker, from the highest priority
+    # template it's allowed to draw that has one. Returns the target and the
+    # template coordinates and color of the pixel, or None.
+    # The lease has to be handed back with target.planner.release afterwards.
+    def get_unset_pixel(self, index, name):
+        for target in self.targets:
+            if not target.allows(name):
+                continue
+            target.update_priority(self.board_max_age)
+            self.record_progress(target)
+
+            # Current pixel row and pixel column being drawn, tracked
+            # separately in every template
+            x, y = self.worker_cursors.get(
+                (index, target.name),
+                self.json_data["workers"][name]["start_coords"],
             )
-            file = ""
-            while True:
-                temp = json.loads(ws.recv())
-                # print("\n",temp)
-                if temp["type"] == "data":
-                    msg = temp["payload"]["data"]["subscribe"]
-                    if msg["data"]["__typename"] == "FullFrameMessageData":
-                        if not temp["id"] in already_added:
-                            imgs.append(
-                                Image.open(
-                                    BytesIO(
-                                        requests.get(
-                                            msg["data"]["name"], stream=True
-                                        ).content
-                                    )
-                                )
-                            )
-                            already_added.append(temp["id"])
-                        break
-            ws.send(json.dumps({"id": str(2 + i), "type": "stop"}))
-
-        ws.close()
-
-        new_img = Image.new("RGB", (1000 * 2, 1000))
-
-        x_offset = 0
-        for img in imgs:
-            new_img.paste(img, (x_offset, 0))
-            x_offset += img.size[0]
-
-        print("Got image:", file)
-
-        return new_img
-
-    def get_unset_pixel(self, boardimg, x, y):
-        pix2 = boardimg.convert("RGB").load()
-        num_loops = 0
-        while True:
-            x += 1
-
-            if x >= self.image_size[0]:
-                y += 1
-                x = 0
-
-            if y >= self.image_size[1]:
-                if num_loops > 1:
-                    target_rgb = self.pix[0, 0]
-                    new_rgb = self.closest_color(target_rgb)
-                    return self.pixel_x_start, self.pixel_y_start, new_rgb
-                y = self.pixel_y_start
-                num_loops += 1
-
-            logging.debug(f"{x+self.pixel_x_start}, {y+self.pixel_y_start}")
-            logging.debug(
-                f"{x}, {y}, boardimg, {self.image_size[0]}, {self.image_size[1]}"
-            )
-
-            # print(self.pix[x, y])
-            target_rgb = self.pix[x, y][:3]
-
-            new_rgb = self.closest_color(target_rgb)
-            if pix2[x + self.pixel_x_start, y + self.pixel_y_start] != new_rgb:
+            width = target.template.size[0]
+            pixel = target.planner.acquire(y * width + x)
+            if pixel is None:
+                continue
+
+            y, x = divmod(pixel, width)
+            self.worker_cursors[index, target.name] = x, y
+            new_color_index = int(target.template.pixels[y, x])
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
                 logging.debug(
-                    f"{pix2[x + self.pixel_x_start, y + self.pixel_y_start]}, {new_rgb}, {new_rgb != (69, 42, 0)}, {pix2[x, y] != new_rgb,}"
+                    "Replacing pixel at: %d,%d with %s",
+                    x + target.origin[0],
+                    y + target.origin[1],
+                    self.color_id_to_name(new_color_index),
                 )
-                if new_rgb != (69, 42, 0):
-                    logging.debug(
-                        f"Replacing {pix2[x+self.pixel_x_start, y+self.pixel_y_start]} pixel at: {x+self.pixel_x_start},{y+self.pixel_y_start} with {new_rgb} color"
-                    )
-                    break
-                else:
-                    print("TransparrentPixel")
-        return x, y, new_rgb
+            return target, x, y, new_color_index
+        return None
 
-    # Draw the input image
+    # Draw a pixel for one worker if its cooldown is over.
+    # Returns the timestamp at which the worker should run again.
     def task(self, index, name, worker):
-        # Whether image should keep drawing itself
-        repeat_forever = True
+        # the worker was removed from the config
+        if self.worker_indices.get(name) != index:
+            logging.info(f"Thread #{index} :: stopped")
+            return None
 
-        while True:
-            # last_time_placed_pixel = math.floor(time.time())
+        # get the current time
+        current_timestamp = time.time()
 
-            # note: Reddit limits us to place 1 pixel every 5 minutes, so I am setting it to
-            # 5 minutes and 30 seconds per pixel
-            if self.unverified_place_frequency:
-                pixel_place_frequency = 1230
-            else:
-                pixel_place_frequency = 330
+        # tokens are refreshed in the background, this only blocks when the
+        # worker has no valid token yet
+        access_token = self.tokens.get(name)
 
-            next_pixel_placement_time = math.floor(time.time()) + pixel_place_frequency
+        # the first run places a pixel immediately
+        next_pixel_placement_time = self.next_pixel_placement_time.get(
+            name, current_timestamp
+        )
 
-            try:
-                # Current pixel row and pixel column being drawn
-                current_r = worker["start_coords"][0]
-                current_c = worker["start_coords"][1]
-            except Exception:
-                print(
-                    f"You need to provide start_coords to worker '{name}'",
+        # draw pixel onto screen
+        if current_timestamp >= next_pixel_placement_time:
+            # get current pixel position from input image and replacement color
+            self.update_board(access_token)
+            unset_pixel = self.get_unset_pixel(index, name)
+
+            if unset_pixel is None and any(
+                target.index.count for target in self.targets if target.allows(name)
+            ):
+                # the pixels left are being placed, one may fail or get
+                # griefed again soon
+                logging.info(f"Thread #{index} :: every wrong pixel is being placed")
+                next_pixel_placement_time = (
+                    current_timestamp + self.leased_recheck_delay
                 )
-                exit(1)
-
-            # Time until next pixel is drawn
-            update_str = ""
-
-            # Refresh auth tokens and / or draw a pixel
-            while True:
-                # reduce CPU usage
-                time.sleep(1)
-
-                # get the current time
-                current_timestamp = math.floor(time.time())
+            elif unset_pixel is None:
+                # nothing to do, check the board again later
+                logging.info(f"Thread #{index} :: image completed")
+                next_pixel_placement_time = (
+                    current_timestamp + self.completed_recheck_delay
+                )
+            else:
+                target, current_r, current_c, pixel_color_index = unset_pixel
+                pixel = current_c * target.template.size[0] + current_r
 
-                # log next time until drawing
-                time_until_next_draw = next_pixel_placement_time - current_timestamp
+                print("\nAccount Placing: ", name, "\n")
 
-                new_update_str = (
-                    f"{time_until_next_draw} seconds until next pixel is drawn"
+                # convert template coordinates to a position on a canvas
+                canvas, canvas_x, canvas_y = self.canvas_layout.locate(
+                    target.origin[0] + current_r,
+                    target.origin[1] + current_c,
                 )
-                if update_str != new_update_str and time_until_next_draw % 10 == 0:
-                    update_str = new_update_str
-
-                logging.info(f"Thread #{index} :: {update_str}")
-
-                # refresh access token if necessary
-                # print("TEST:", self.access_token_expires_at_timestamp, "INDEX:", index)
-                if (
-                    len(self.access_tokens) == 0
-                    or len(self.access_token_expires_at_timestamp) == 0
-                    or
-                    # index in self.access_tokens
-                    index not in self.access_token_expires_at_timestamp
-                    or (
-                        self.access_token_expires_at_timestamp.get(index)
-                        and current_timestamp
-                        >= self.access_token_expires_at_timestamp.get(index)
-                    )
-                ):
-                    logging.info(f"Thread #{index} :: Refreshing access token")
-
-                    # developer's reddit username and password
-                    try:
-                        username = name
-                        password = worker["password"]
-                        # note: use https://www.reddit.com/prefs/apps
-                        app_client_id = worker["client_id"]
-                        secret_key = worker["client_secret"]
-                    except Exception:
-                        print(
-                            f"You need to provide all required fields to worker '{name}'",
-                        )
-                        exit(1)
-
-                    data = {
-                        "grant_type": "password",
-                        "username": username,
-                        "password": password,
-                    }
 
-                    r = requests.post(
-                        "https://ssl.reddit.com/api/v1/access_token",
-                        data=data,
-                        auth=HTTPBasicAuth(app_client_id, secret_key),
-                        headers={"User-agent": f"placebot{random.randint(1, 100000)}"},
+                # draw the pixel onto r/place, handing the pixel back to the
+                # planner whatever happens
+                placed = False
+                try:
+                    placement = self.set_pixel_and_check_ratelimit(
+                        access_token,
+                        canvas_x,
+                        canvas_y,
+                        pixel_color_index,
+                        canvas,
                     )
-
-                    logging.debug(f"Received response: {r.text}")
-
-                    response_data = r.json()
-
-                    if "error" in response_data:
-                        print(
-                            f"An error occured. Make sure you have the correct credentials. Response data: {response_data}"
+                    next_pixel_placement_time, placed = placement
+                    if placed:
+                        # no need to wait for the board to show it
+                        target.index.mark(pixel, pixel_color_index)
+                        self.placement_verifier.add(
+                            target, pixel, pixel_color_index, name
                         )
-                        exit(1)
-
-                    self.access_tokens[index] = response_data["access_token"]
-                    # access_token_type = response_data["token_type"]  # this is just "bearer"
-                    access_token_expires_in_seconds = response_data[
-                        "expires_in"
-                    ]  # this is usually "3600"
-                    # access_token_scope = response_data["scope"]  # this is usually "*"
-
-                    # ts stores the time in seconds
-                    self.access_token_expires_at_timestamp[
-                        index
-                    ] = current_timestamp + int(access_token_expires_in_seconds)
-
-                    logging.info(
-                        f"Received new access token: {self.access_tokens.get(index)[:5]}************"
+                    metrics.inc(
+                        "placements_total",
+                        account=name,
+                        result="succeeded" if placed else "ratelimited",
                     )
+                except Exception:
+                    metrics.inc("placements_total", account=name, result="failed")
+                    raise
+                finally:
+                    target.planner.release(pixel, placed)
 
-                # draw pixel onto screen
-                if self.access_tokens.get(index) is not None and (
-                    current_timestamp >= next_pixel_placement_time
-                    or self.first_run_counter <= index
-                ):
-
-                    # place pixel immediately
-                    # first_run = False
-                    self.first_run_counter += 1
+            self.next_pixel_placement_time.set(name, next_pixel_placement_time)
 
-                    # get target color
-                    # target_rgb = pix[current_r, current_c]
-
-                    # get current pixel position from input image and replacement color
-                    current_r, current_c, new_rgb = self.get_unset_pixel(
-                        self.get_board(self.access_tokens[index]),
-                        current_r,
-                        current_c,
-                    )
+        # log next time until drawing
+        logging.info(
+            "Thread #%d :: %d seconds until next pixel is drawn",
+            index,
+            math.ceil(next_pixel_placement_time - current_timestamp),
+        )
 
-                    # get converted color
-                    new_rgb_hex = self.rgb_to_hex(new_rgb)
-                    pixel_color_index = color_map[new_rgb_hex]
-
-                    print("\nAccount Placing: ", name, "\n")
-
-                    # draw the pixel onto r/place
-                    # There's a better way to do this
-                    canvas = 0
-                    self.pixel_x_start += current_r
-                    self.pixel_y_start += current_c
-                    while self.pixel_x_start > 999:
-                        self.pixel_x_start -= 1000
-                        canvas += 1
-
-                    # draw the pixel onto r/place
-                    next_pixel_placement_time = self.set_pixel_and_check_ratelimit(
-                        self.access_tokens[index],
-                        self.pixel_x_start,
-                        self.pixel_y_start,
-                        pixel_color_index,
-                        canvas,
-                    )
+        return next_pixel_placement_time
 
-                    current_r += 1
+    def start(self):
+        self.scheduler = Scheduler(self.scheduler_threads)
+        self.update_workers()
 
-                    # go back to first column when reached end of a row while drawing
-                    if current_r >= self.image_size[0]:
-                        current_r = 0
-                        current_c += 1
+        if self.reload_interval:
+            self.scheduler.schedule(
+                "Reload", time.time() + self.reload_interval, self.reload_job
+            )
+        # kill -HUP reloads right away, off the signal handler
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(
+                signal.SIGHUP,
+                lambda *_: threading.Thread(target=self.reload, daemon=True).start(),
+            )
 
-                    # exit when all pixels drawn
-                    if current_c >= self.image_size[1]:
-                        logging.info(f"Thread #{index} :: image completed")
-                        break
+        self.scheduler.run()
 
-            if not repeat_forever:
-                break
 
-    def start(self):
-        for index, worker in enumerate(self.json_data["workers"]):
-            threading.Thread(
-                target=self.task,
-                args=[index, worker, self.json_data["workers"][worker]],
-            ).start()
-            # exit(1)
-            time.sleep(self.delay_between_launches)
+def file_signature(path):
+    # Modification time and size, None for missing files
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
 
 
 if __name__ == "__main__":
@@ -548,6 +727,42 @@ if __name__ == "__main__":
         const=logging.DEBUG,
         default=logging.INFO,
     )
+    parser.add_argument(
+        "--processes",
+        help="Shard the workers across this many processes",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--simulate",
+        help="Estimate how long the templates take and how many accounts they need, without placing anything",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--damage-rate",
+        help="Template pixels griefed per minute in the simulation",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--hours",
+        help="How many hours to simulate",
+        type=float,
+        default=24,
+    )
+    parser.add_argument(
+        "--target-accuracy",
+        help="Share of right pixels the simulation finds the accounts needed for",
+        type=float,
+        default=0.99,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the script, writing PATH.prof and PATH.txt on exit or SIGUSR1",
+        nargs="?",
+        const="profile",
+        metavar="PATH",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -557,6 +772,24 @@ if __name__ == "__main__":
     )
     logging.info("place-script started")
 
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(args.profile)
+        profiler.start()
+
     client = PlaceClient()
+    if profiler is not None:
+        profiler.instrument(client, "get_unset_pixel", "scan")
+        profiler.instrument(client, "update_board", "board")
+        profiler.instrument(client, "set_pixel_and_check_ratelimit", "placement")
+        profiler.instrument(client.tokens, "request_token", "token")
     # Start everything
-    client.start()
+    if args.simulate:
+        simulate(client, args.damage_rate, args.hours, args.target_accuracy)
+    elif args.processes > 1:
+        # shards builds on PlaceClient, so it can only be imported from here
+        from shards import Coordinator
+
+        Coordinator(client, args.processes, logging.getLogger().level).run()
+    else:
+        client.start()
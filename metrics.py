@@ -0,0 +1,164 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from files import atomic_write
+
+
+class Metrics:
+    """Counters, gauges and summaries, exported in the Prometheus text format.
+
+    Recording is always on and cheap, exporting is opt-in through serve()
+    (an HTTP /metrics endpoint) or dump_periodically() (a JSON file).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of pairs
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count, sum, max]
+        self.summaries = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self.summaries.setdefault(key, [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def update_from(self, snapshot, **labels):
+        """Take over the metrics of another process, as returned by its to_dict().
+
+        labels are added to all of them to tell processes apart. Values are
+        replaced, not added, so the same process can send snapshots repeatedly.
+        """
+        extra = tuple(labels.items())
+
+        def key(sample):
+            return (sample["name"], tuple(sorted((*sample["labels"].items(), *extra))))
+
+        with self._lock:
+            for sample in snapshot["counters"]:
+                self.counters[key(sample)] = sample["value"]
+            for sample in snapshot["gauges"]:
+                self.gauges[key(sample)] = sample["value"]
+            for sample in snapshot["summaries"]:
+                self.summaries[key(sample)] = [
+                    sample["count"],
+                    sample["sum"],
+                    sample["max"],
+                ]
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            summaries = sorted(self.summaries.items())
+
+        lines = []
+        for kind, samples in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for (name, _), _ in samples}):
+                lines.append(f"# TYPE placebot_{name} {kind}")
+                lines.extend(
+                    f"placebot_{name}{format_labels(labels)} {value}"
+                    for (sample_name, labels), value in samples
+                    if sample_name == name
+                )
+        for name in sorted({name for (name, _), _ in summaries}):
+            lines.append(f"# TYPE placebot_{name} summary")
+            for (sample_name, labels), (count, total, maximum) in summaries:
+                if sample_name != name:
+                    continue
+                lines.append(f"placebot_{name}_count{format_labels(labels)} {count}")
+                lines.append(f"placebot_{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"placebot_{name}_max{format_labels(labels)} {maximum}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.gauges.items()
+                ],
+                "summaries": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": summary[0],
+                        "sum": summary[1],
+                        "max": summary[2],
+                    }
+                    for (name, labels), summary in self.summaries.items()
+                ],
+            }
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serve /metrics on a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    def dump_periodically(self, path, interval):
+        """Write the metrics as JSON to path every interval seconds."""
+
+        def dump():
+            while True:
+                time.sleep(interval)
+                with atomic_write(path) as f:
+                    json.dump(self.to_dict(), f)
+
+        threading.Thread(target=dump, daemon=True).start()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+# Shared by every module of the client
+metrics = Metrics()
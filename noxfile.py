@@ -1,6 +1,31 @@
 import nox
 
-locations = "main.py", "noxfile.py", "mappings.py"
+locations = (
+    "main.py",
+    "noxfile.py",
+    "mappings.py",
+    "palette.py",
+    "template.py",
+    "diff.py",
+    "board.py",
+    "scheduler.py",
+    "session.py",
+    "planner.py",
+    "priority.py",
+    "tokens.py",
+    "metrics.py",
+    "cooldowns.py",
+    "targets.py",
+    "color.py",
+    "dither.py",
+    "shards.py",
+    "history.py",
+    "verify.py",
+    "simulate.py",
+    "profiling.py",
+    "files.py",
+    "benchmarks",
+)
 
 
 @nox.session
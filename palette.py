@@ -0,0 +1,190 @@
+import itertools
+
+import numpy as np
+from PIL import ImageColor
+
+from color import ciede2000, srgb_to_lab
+from mappings import color_map
+
+# Ways of measuring how close two colors are: euclidean distance in RGB, in
+# CIELAB (CIE76) or the CIEDE2000 difference
+MATCHING = ("rgb", "cie76", "ciede2000")
+
+# Perceptual matching can be looked up in a table over a grid with this many
+# levels per channel instead, which moves colors by at most 2 per channel
+LOOKUP_LEVELS = 64
+
+# Colors matched at once, bounds the (colors, palette size) temporaries
+CHUNK_SIZE = 1 << 16
+
+
+def pack_rgb(pixels):
+    """Pack an (..., 3) array of RGB values into 0xRRGGBB int32s."""
+    # Built in place, templates and boards are big enough for temporaries
+    # to matter
+    packed = pixels[..., 0].astype(np.int32)
+    packed <<= 8
+    packed |= pixels[..., 1]
+    packed <<= 8
+    packed |= pixels[..., 2]
+    return packed
+
+
+class Palette:
+    """Maps arbitrary RGB colors to r/place palette indices.
+
+    Results are cached per source color, so the distance search against the
+    palette only ever runs once for every distinct color of a template.
+    closest_index() always uses RGB distance, quantize() and nearest() can
+    match perceptually too, see MATCHING.
+    """
+
+    def __init__(self, colors=color_map):
+        self.hex_to_index = dict(colors)
+        self.indices = list(colors.values())
+        self.colors = [ImageColor.getcolor(color_hex, "RGB") for color_hex in colors]
+        self.index_to_rgb = dict(zip(self.indices, self.colors))
+
+        # Palette colors map onto themselves, seed the cache with them
+        self._cache = {rgb: index for index, rgb in self.index_to_rgb.items()}
+
+        self._colors_array = np.array(self.colors, dtype=np.int32)
+        self._indices_array = np.array(self.indices, dtype=np.uint8)
+
+        # RGB value of every possible palette index, for vectorized lookups
+        self.rgb_table = np.zeros((256, 3), dtype=np.uint8)
+        self.rgb_table[self._indices_array] = self.colors
+        self._colors_float = self._colors_array.astype(np.float64)
+        self._squared_norms = (self._colors_array**2).sum(axis=1)
+        self._lab = srgb_to_lab(self._colors_array)
+        self._lab_squared_norms = (self._lab**2).sum(axis=1)
+        # Matching -> lookup table, built on first use
+        self._tables = {}
+
+        # Exact lookups of packed 0xRRGGBB colors: the smallest modulus that
+        # tells all palette colors apart indexes a tiny table
+        packed = pack_rgb(self._colors_array)
+        self._modulus = next(
+            modulus
+            for modulus in itertools.count(len(packed))
+            if len(np.unique(packed % modulus)) == len(packed)
+        )
+        self._modulus_table = np.zeros(self._modulus, dtype=np.uint8)
+        self._modulus_table[packed % self._modulus] = self._indices_array
+        self._packed_table = np.full(256, -1, dtype=np.int32)
+        self._packed_table[self._indices_array] = packed
+
+    def closest_index(self, rgb):
+        rgb = tuple(rgb[:3])
+        try:
+            return self._cache[rgb]
+        except KeyError:
+            pass
+
+        r, g, b = rgb
+        best_index = None
+        best_diff = None
+        for index, (cr, cg, cb) in zip(self.indices, self.colors):
+            # Squared distance orders the same way as the euclidean one
+            color_diff = (r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2
+            if best_diff is None or color_diff < best_diff:
+                best_diff = color_diff
+                best_index = index
+
+        self._cache[rgb] = best_index
+        return best_index
+
+    def closest_rgb(self, rgb):
+        return self.index_to_rgb[self.closest_index(rgb)]
+
+    def nearest(self, colors, matching="rgb", exact=True):
+        """Positions in self.colors of the closest palette colors.
+
+        colors is an (n, 3) array of RGB values, which may be fractional.
+        Unless exact is set, perceptual matching uses a lookup table, see
+        LOOKUP_LEVELS. CIEDE2000 is too slow to run for every color of a big
+        image and always does.
+        """
+        if matching not in MATCHING:
+            raise ValueError(
+                f"Unknown color matching {matching!r}, use one of {', '.join(MATCHING)}"
+            )
+        colors = np.asarray(colors)
+        if matching == "rgb":
+            # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, and |c|^2 doesn't change
+            # the order. Exact for whole RGB values.
+            return np.argmin(
+                self._squared_norms - 2 * (colors @ self._colors_float.T),
+                axis=1,
+            )
+        if exact and matching == "cie76":
+            return self._nearest_lab(srgb_to_lab(colors), matching)
+
+        if matching not in self._tables:
+            self._tables[matching] = self._build_table(matching)
+        grid = np.rint(colors * ((LOOKUP_LEVELS - 1) / 255)).astype(np.intp)
+        return self._tables[matching][grid[:, 0], grid[:, 1], grid[:, 2]]
+
+    def _nearest_lab(self, lab, matching):
+        if matching == "cie76":
+            return np.argmin(self._lab_squared_norms - 2 * lab @ self._lab.T, axis=1)
+        return np.argmin(ciede2000(lab[:, np.newaxis, :], self._lab), axis=1)
+
+    def _build_table(self, matching):
+        levels = np.arange(LOOKUP_LEVELS) * 255 / (LOOKUP_LEVELS - 1)
+        grid = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1)
+        lab = srgb_to_lab(grid.reshape(-1, 3))
+
+        table = np.empty(len(lab), dtype=np.uint8)
+        for start in range(0, len(lab), CHUNK_SIZE // 8):
+            chunk = np.s_[start : start + CHUNK_SIZE // 8]
+            table[chunk] = self._nearest_lab(lab[chunk], matching)
+        return table.reshape(grid.shape[:-1])
+
+    def quantize(self, pixels, matching="rgb"):
+        """Quantize an (..., 3) array of RGB values into palette indices.
+
+        Every distinct color is matched against the palette once, then the
+        result is broadcast back over the whole array.
+        """
+        pixels = np.asarray(pixels)
+        packed = pack_rgb(pixels)
+
+        if packed.size > 1 << 20:
+            # Big images: a table over all 2^24 colors beats sorting
+            present = np.zeros(1 << 24, dtype=bool)
+            present[packed] = True
+            unique = np.flatnonzero(present)
+            table = np.zeros(1 << 24, dtype=np.uint8)
+            table[unique] = self._match_packed(unique, matching)
+            return table[packed]
+
+        unique, inverse = np.unique(packed, return_inverse=True)
+        return self._match_packed(unique, matching)[inverse.reshape(-1)].reshape(
+            packed.shape
+        )
+
+    def _match_packed(self, packed, matching):
+        # Palette indices for 0xRRGGBB colors, a chunk at a time
+        rgb = np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], 1)
+        indices = np.empty(len(packed), dtype=np.uint8)
+        for start in range(0, len(packed), CHUNK_SIZE):
+            chunk = np.s_[start : start + CHUNK_SIZE]
+            indices[chunk] = self._indices_array[self.nearest(rgb[chunk], matching)]
+        return indices
+
+    def to_indices(self, pixels):
+        """Convert an (..., 3) array of board RGB values into palette indices.
+
+        The board only ever shows palette colors, so those are looked up
+        directly and only anything else goes through quantize().
+        """
+        pixels = np.asarray(pixels)
+        packed = pack_rgb(pixels)
+        indices = self._modulus_table[packed % self._modulus]
+
+        # Other colors can land on a palette color's slot too
+        exact = self._packed_table[indices] == packed
+        if not exact.all():
+            indices[~exact] = self.quantize(pixels[~exact])
+        return indices
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import numpy as np
+
+
+class PlacementPlanner:
+    """Hands out wrong template pixels so no two workers fix the same one.
+
+    Pixels are flat template indices (y * template_width + x), the wrong ones
+    come from a MismatchIndex. Without priority scores pixels are handed out
+    in raster order starting after the worker's own position, otherwise
+    highest score first. A pixel that was handed out is leased: nobody else
+    gets it until the placement failed or lease_time seconds passed, which
+    gives the board time to catch up with successful placements.
+    """
+
+    def __init__(self, index, lease_time=60, leases=None, lock=None):
+        self.index = index
+        self.lease_time = lease_time
+        # Processes drawing the same template share leases and their lock
+        self._lock = threading.Lock() if lock is None else lock
+        # Pixels in the order they should be handed out, None for raster
+        self._order = None
+        # Everything before this position in _order has been fixed already
+        self._start = 0
+        # Pixel -> time.monotonic() its lease runs out at
+        self._leases = {} if leases is None else leases
+
+    def update(self, mismatches, scores=None):
+        """Order the given wrong pixels by score, None goes back to raster order."""
+        with self._lock:
+            self._order = None
+            self._start = 0
+            if scores is not None:
+                # Stable, so equal scores keep their raster order
+                self._order = mismatches[np.argsort(-scores, kind="stable")]
+            self._prune()
+
+    def prune(self):
+        """Drop leases that ran out or whose pixel is right by now."""
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        now = time.monotonic()
+        for pixel, expires_at in list(self._leases.items()):
+            if expires_at <= now or not self.index.is_wrong(pixel):
+                del self._leases[pixel]
+
+    def acquire(self, after=-1):
+        """Lease the next free wrong pixel.
+
+        In raster order that's the first one after the given pixel, wrapping
+        around. Returns None if every wrong pixel is already leased.
+        """
+        with self._lock:
+            if self._order is None:
+                pixel = after
+                for _ in range(self.index.count):
+                    pixel = self.index.next_after(pixel)
+                    if pixel is None:
+                        break
+                    if self._lease(pixel):
+                        return pixel
+                return None
+
+            for position in range(self._start, len(self._order)):
+                pixel = int(self._order[position])
+                if not self.index.is_wrong(pixel):
+                    # Fixed since the order was computed, skip it for good
+                    if position == self._start:
+                        self._start += 1
+                    continue
+                if self._lease(pixel):
+                    return pixel
+            return None
+
+    def _lease(self, pixel):
+        now = time.monotonic()
+        if self._leases.get(pixel, 0) > now:
+            return False
+        self._leases[pixel] = now + self.lease_time
+        return True
+
+    def release(self, pixel, placed):
+        """Report the result of placing a leased pixel.
+
+        Failed pixels go straight back into the queue, placed ones stay
+        leased until the board shows them or the lease runs out.
+        """
+        with self._lock:
+            if placed:
+                self._leases[pixel] = time.monotonic() + self.lease_time
+            else:
+                self._leases.pop(pixel, None)
+
+    def settle(self, pixel):
+        """A board frame showed what became of a placed pixel, stop holding it.
+
+        If it's wrong again it goes back into the queue right away.
+        """
+        with self._lock:
+            self._leases.pop(pixel, None)
+
+
+class SharedLeases:
+    """Pixel leases kept in a flat array of expiry times instead of a dict.
+
+    Behaves like the dict PlacementPlanner uses by default, but the array
+    can live in shared memory so several processes lease from the same pool.
+    0 means not leased.
+    """
+
+    def __init__(self, expiry):
+        self.expiry = expiry
+
+    def get(self, pixel, default=None):
+        expires_at = float(self.expiry[pixel])
+        return expires_at if expires_at else default
+
+    def __setitem__(self, pixel, expires_at):
+        self.expiry[pixel] = expires_at
+
+    def __delitem__(self, pixel):
+        self.expiry[pixel] = 0
+
+    def pop(self, pixel, default=None):
+        expires_at = self.get(pixel, default)
+        self.expiry[pixel] = 0
+        return expires_at
+
+    def items(self):
+        pixels = np.flatnonzero(self.expiry)
+        return zip(pixels.tolist(), self.expiry[pixels].tolist())
@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from template import TRANSPARENT
+
+
+class Prioritizer:
+    """Decides which wrong pixels get fixed first.
+
+    strategy names one of the functions in STRATEGIES. Each gets the
+    prioritizer, the board region under the template (as palette indices)
+    and the (ys, xs) template coordinates of the wrong pixels, and returns
+    one score per pixel, higher scores being fixed first. A strategy
+    returning None keeps the plain raster order.
+
+    Pixels whose placements keep getting overwritten are fixed after all the
+    others, whatever the strategy. overwrites can pass in the array keeping
+    track of them when it's shared with other processes.
+    """
+
+    def __init__(
+        self,
+        strategy,
+        template,
+        palette,
+        mask=None,
+        overwrites=None,
+        overwrite_half_life=3600,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError(
+                f"Unknown priority strategy {strategy!r}, use one of {', '.join(STRATEGIES)}"
+            )
+        if strategy == "mask" and mask is None:
+            raise ValueError("The mask priority strategy needs a priority mask image")
+
+        self.strategy = strategy
+        self.template = template
+        self.palette = palette
+        self.mask = mask
+        self.outline = template_outline(template.pixels)
+
+        # time.time() each template pixel was last seen turning wrong
+        self.last_flip = np.zeros(template.pixels.shape, dtype=np.float64)
+        self._wrong = np.zeros(template.pixels.shape, dtype=bool)
+
+        # How often our placements on every pixel were lost, as of the time
+        # in the second layer. The count halves every overwrite_half_life
+        # seconds, so pixels get another chance once the fight is over.
+        if overwrites is None:
+            overwrites = np.zeros((2, *template.pixels.shape), dtype=np.float64)
+        self.overwrites = overwrites
+        self.overwrite_half_life = overwrite_half_life
+
+    def same_settings(self, other):
+        """Whether other scores the same way, ignoring what it has seen so far."""
+        if self.strategy != other.strategy or (self.mask is None) != (
+            other.mask is None
+        ):
+            return False
+        return self.mask is None or np.array_equal(self.mask, other.mask)
+
+    def score(self, region, mismatches, now):
+        """Return priority scores for mismatches, or None for raster order."""
+        ys, xs = np.divmod(mismatches, self.template.size[0])
+
+        # Keep track of when pixels flipped, for the recent strategy
+        wrong = np.zeros(self._wrong.shape, dtype=bool)
+        wrong[ys, xs] = True
+        self.last_flip[wrong & ~self._wrong] = now
+        self._wrong = wrong
+
+        scores = STRATEGIES[self.strategy](self, region, ys, xs)
+
+        deferred = self.deferred(ys, xs, now)
+        if deferred.any():
+            if scores is None:
+                # Raster order, earlier pixels first
+                scores = -mismatches
+            # Keep the strategy's order, ties in raster order, but behind
+            # every pixel lost less often
+            order = np.lexsort((-np.arange(len(scores)), scores))
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = np.arange(len(order))
+            scores = ranks - deferred * len(ranks)
+        return scores
+
+    def record_overwrite(self, y, x, now):
+        """Count a placement of ours at template coordinates that was lost."""
+        count, counted_at = self.overwrites[:, y, x]
+        self.overwrites[0, y, x] = self._decay(count, counted_at, now) + 1
+        self.overwrites[1, y, x] = now
+
+    def deferred(self, ys, xs, now):
+        """How far back pixels are pushed, the rounded overwrite counts."""
+        counts = self.overwrites[0, ys, xs]
+        deferred = np.zeros(len(counts), dtype=np.int64)
+        lost = np.flatnonzero(counts)
+        deferred[lost] = np.rint(
+            self._decay(counts[lost], self.overwrites[1, ys[lost], xs[lost]], now)
+        )
+        return deferred
+
+    def _decay(self, count, counted_at, now):
+        return count * 0.5 ** ((now - counted_at) / self.overwrite_half_life)
+
+
+def template_outline(pixels):
+    """Mark the non-transparent pixels bordering transparency or the image edge."""
+    opaque = np.pad(pixels != TRANSPARENT, 1, constant_values=False)
+    inner = opaque[:-2, 1:-1] & opaque[2:, 1:-1] & opaque[1:-1, :-2] & opaque[1:-1, 2:]
+    return opaque[1:-1, 1:-1] & ~inner
+
+
+def load_priority_mask(path, size):
+    """Load a grayscale priority mask, brighter pixels are fixed first."""
+    with Image.open(path) as im:
+        if im.size != size:
+            raise ValueError(
+                f"Priority mask {path} is {im.size}, but the template is {size}"
+            )
+        return np.asarray(im.convert("L"))
+
+
+def default_mask_path(image_path):
+    # image.png -> image.priority.png
+    root, extension = os.path.splitext(image_path)
+    return f"{root}.priority{extension}"
+
+
+def raster_priority(prioritizer, region, ys, xs):
+    return None
+
+
+def color_error_priority(prioritizer, region, ys, xs):
+    target = prioritizer.palette.rgb_table[prioritizer.template.pixels[ys, xs]]
+    current = prioritizer.palette.rgb_table[region[ys, xs]]
+    return ((target.astype(np.int32) - current) ** 2).sum(axis=1)
+
+
+def outline_priority(prioritizer, region, ys, xs):
+    return prioritizer.outline[ys, xs].astype(np.int32)
+
+
+def recent_priority(prioritizer, region, ys, xs):
+    return prioritizer.last_flip[ys, xs]
+
+
+def mask_priority(prioritizer, region, ys, xs):
+    return prioritizer.mask[ys, xs].astype(np.int32)
+
+
+STRATEGIES = {
+    "raster": raster_priority,
+    "color_error": color_error_priority,
+    "outline": outline_priority,
+    "recent": recent_priority,
+    "mask": mask_priority,
+}
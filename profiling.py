@@ -0,0 +1,141 @@
+import atexit
+import bisect
+import cProfile
+import functools
+import logging
+import pstats
+import signal
+import threading
+import time
+
+# Upper bounds of the stage histogram buckets in seconds, four per power of
+# ten from 10us to 100s. Slower calls land in one more bucket.
+BUCKETS = [10 ** (exponent / 4) for exponent in range(-20, 9)]
+
+
+class Histogram:
+    """Counts of durations per bucket of BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if bucket == len(BUCKETS):
+                    return self.max
+                # The bound can be above the slowest call seen
+                return min(BUCKETS[bucket], self.max)
+        return 0.0
+
+
+class Snapshot:
+    """Stats of a profile that keeps running, for pstats.Stats."""
+
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        # pstats would otherwise stop the profile
+        pass
+
+
+class Profiler:
+    """Profiles every thread with cProfile and times the client's stages.
+
+    Stages are methods wrapped with instrument(), every call adds its
+    duration to the stage's histogram. Nothing is wrapped or profiled unless
+    this is started, so without --profile it costs nothing. The results are
+    written to <path>.prof, for pstats or snakeviz, and a readable summary
+    to <path>.txt on exit, and whenever the process gets SIGUSR1.
+    """
+
+    def __init__(self, path="profile"):
+        self.path = path
+        # Stage -> Histogram
+        self.stages = {}
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def instrument(self, owner, attribute, stage):
+        """Time every call of owner.attribute as stage."""
+        function = getattr(owner, attribute)
+        histogram = self.stages.setdefault(stage, Histogram())
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                with self._lock:
+                    histogram.observe(seconds)
+
+        setattr(owner, attribute, timed)
+
+    def start(self):
+        # Threads started from now on profile themselves, see _profile_thread
+        threading.setprofile(self._profile_thread)
+        self._profile_thread()
+        atexit.register(self.dump)
+        # Killing the script should write the profile too
+        signal.signal(signal.SIGTERM, lambda *_: exit(0))
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(
+                signal.SIGUSR1,
+                lambda *_: threading.Thread(target=self.dump, daemon=True).start(),
+            )
+
+    def _profile_thread(self, *_):
+        # Runs as the first profile hook of a new thread, then cProfile
+        # takes over as its profiler
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def summary(self):
+        """Stage histograms as a table."""
+        lines = [
+            f"{'stage':<12} {'calls':>8} {'mean':>10} {'p50':>10} {'p90':>10}"
+            f" {'p99':>10} {'max':>10}"
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self.stages.items()):
+                mean = histogram.total / histogram.count if histogram.count else 0.0
+                times = [mean, *map(histogram.quantile, (0.5, 0.9, 0.99))]
+                times.append(histogram.max)
+                lines.append(
+                    f"{stage:<12} {histogram.count:>8}"
+                    + "".join(f" {seconds * 1000:>8.3f}ms" for seconds in times)
+                )
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        with self._lock:
+            snapshots = [Snapshot(profile) for profile in self._profiles]
+        stats = pstats.Stats(*snapshots)
+        stats.dump_stats(f"{self.path}.prof")
+
+        with open(f"{self.path}.txt", "w") as f:
+            f.write(self.summary())
+            f.write("\n")
+            stats.stream = f
+            stats.sort_stats("tottime").print_stats(30)
+            stats.sort_stats("cumulative").print_stats(30)
+        logging.info(f"Wrote profile to {self.path}.prof and {self.path}.txt")
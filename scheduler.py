@@ -0,0 +1,75 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class Scheduler:
+    """Runs jobs when they become due, on a fixed number of threads.
+
+    A job is a callable returning the timestamp (as in time.time()) it wants
+    to run again at, or None once it's finished. A single dispatcher sleeps
+    until the earliest due job, so idle jobs cost nothing no matter how many
+    of them there are.
+    """
+
+    def __init__(self, pool_size=8, retry_delay=60):
+        self.retry_delay = retry_delay
+        self._pool = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="worker"
+        )
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def schedule(self, name, when, job):
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), name, job))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._pool.shutdown(wait=False)
+
+    def run(self):
+        """Dispatch jobs until stop() is called."""
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                now = time.time()
+                when, _, name, job = self._heap[0]
+                if when > now:
+                    self._condition.wait(when - now)
+                    continue
+
+                heapq.heappop(self._heap)
+                self._pool.submit(self._run_job, name, when, job)
+
+    def _run_job(self, name, when, job):
+        # How long the job waited for a free thread after becoming due
+        lag = max(0.0, time.time() - when)
+        metrics.observe("scheduler_lag_seconds", lag)
+        logging.debug("%s :: started %.3fs after due", name, lag)
+        try:
+            next_run = job()
+        except SystemExit:
+            logging.error(f"{name} :: stopped")
+            return
+        except Exception:
+            logging.exception(
+                f"{name} :: failed, retrying in {self.retry_delay} seconds"
+            )
+            next_run = time.time() + self.retry_delay
+
+        if next_run is not None:
+            self.schedule(name, next_run, job)
@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def __str__(self):
+        average = self.total / self.count if self.count else 0.0
+        return f"{self.count} requests, avg {average * 1000:.0f}ms, max {self.max * 1000:.0f}ms"
+
+
+class HttpClient:
+    """A keep-alive connection pool shared by every HTTP call the client makes.
+
+    Requests are tagged with an endpoint name, latencies are tracked per
+    endpoint and logged every log_interval seconds.
+    """
+
+    def __init__(self, pool_size=16, timeout=10, log_interval=60):
+        self.timeout = timeout
+        self.log_interval = log_interval
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.latencies = {}
+        self._lock = threading.Lock()
+        self._last_log = time.monotonic()
+
+    def request(self, method, url, endpoint, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self._record(endpoint, time.perf_counter() - start)
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request("GET", url, endpoint, **kwargs)
+
+    def post(self, url, endpoint, **kwargs):
+        return self.request("POST", url, endpoint, **kwargs)
+
+    def _record(self, endpoint, seconds):
+        metrics.observe("http_request_seconds", seconds, endpoint=endpoint)
+        with self._lock:
+            self.latencies.setdefault(endpoint, LatencyStats()).add(seconds)
+
+            if time.monotonic() - self._last_log < self.log_interval:
+                return
+            self._last_log = time.monotonic()
+            summary = "; ".join(
+                f"{name}: {stats}" for name, stats in sorted(self.latencies.items())
+            )
+        logging.info(f"HTTP latency :: {summary}")
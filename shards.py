@@ -0,0 +1,391 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from cooldowns import CooldownState
+from diff import MismatchIndex, index_arrays
+from main import PlaceClient
+from metrics import metrics
+from planner import PlacementPlanner, SharedLeases
+from scheduler import Scheduler
+from targets import Target
+from template import Template
+from tokens import TokenManager
+
+# In seconds, how often shards send their metrics to the coordinator
+METRICS_INTERVAL = 10
+
+
+class SharedArrays:
+    """Numpy arrays living in one block of shared memory.
+
+    The process that creates the block owns it, others attach to it with
+    its spec and see the very same memory, nothing is copied.
+    """
+
+    def __init__(self, memory, layout, owner=False):
+        self.memory = memory
+        # Key -> (shape, dtype, offset in the block)
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {
+            key: np.ndarray(shape, dtype, memory.buf, offset)
+            for key, (shape, dtype, offset) in layout.items()
+        }
+
+    @classmethod
+    def create(cls, shapes):
+        """Allocate zeroed arrays, shapes maps keys to (shape, dtype)."""
+        layout = {}
+        size = 0
+        for key, (shape, dtype) in shapes.items():
+            dtype = np.dtype(dtype)
+            layout[key] = (shape, dtype.str, size)
+            # Keep every array 8 byte aligned
+            size += -(-int(np.prod(shape)) * dtype.itemsize // 8) * 8
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        shared = cls(memory, layout, owner=True)
+        for array in shared.arrays.values():
+            array.fill(0)
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        name, layout = spec
+        return cls(shared_memory.SharedMemory(name=name), layout)
+
+    @property
+    def spec(self):
+        """Picklable description for attach() in another process."""
+        return self.memory.name, self.layout
+
+    def group(self, prefix):
+        """Arrays whose keys start with prefix, keyed without it."""
+        return {
+            key[len(prefix) :]: array
+            for key, array in self.arrays.items()
+            if key.startswith(prefix)
+        }
+
+    def close(self):
+        # Targets may still hold views into the block, so only its name is
+        # removed, the memory goes away with the last process using it
+        if self.owner:
+            self.memory.unlink()
+
+
+def shared_target(client, description, arrays):
+    """Build a Target whose template, index and leases are in shared memory."""
+    template = Template(arrays["pixels"])
+    index_lock, planner_lock = description["locks"]
+    index = MismatchIndex(template, arrays, index_lock)
+    planner = PlacementPlanner(
+        index, client.pixel_lease_time, SharedLeases(arrays["leases"]), planner_lock
+    )
+    return Target(
+        description["name"],
+        template,
+        description["origin"],
+        client.load_prioritizer(description["config"], template, arrays["overwrites"]),
+        description["priority"],
+        description["workers"],
+        index=index,
+        planner=planner,
+    )
+
+
+class ShardTokens(TokenManager):
+    """TokenManager of a shard, the coordinator caches the tokens it gets."""
+
+    def __init__(self, reports, *args, **kwargs):
+        self.reports = reports
+        super().__init__(*args, **kwargs)
+
+    def request_token(self, name):
+        token, expires_at = super().request_token(name)
+        self.reports.put(("token", name, token, expires_at))
+        return token, expires_at
+
+
+class ShardCooldowns(CooldownState):
+    """CooldownState of a shard, the coordinator saves the cooldowns for it."""
+
+    def __init__(self, reports, times):
+        self.reports = reports
+        super().__init__()
+        self._times.update(times)
+
+    def set(self, name, timestamp):
+        super().set(name, timestamp)
+        self.reports.put(("cooldown", name, timestamp))
+
+
+class ShardVerifier:
+    """Placement verifier of a shard, the coordinator sees the board and verifies."""
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def add(self, target, pixel, color, account, placed_at=None):
+        if placed_at is None:
+            placed_at = time.time()
+        self.reports.put(("placed", target.name, pixel, color, account, placed_at))
+
+    def observe(self, offset, frame, mask=None, now=None):
+        pass
+
+
+class ShardClient(PlaceClient):
+    """PlaceClient running some of the workers in a process of its own.
+
+    Templates and mismatch indexes are the coordinator's, in shared memory,
+    so a shard never fetches the board. Pixels it places go straight into
+    the shared indexes, tokens, cooldowns, placements and metrics are
+    reported to the coordinator, which persists, verifies and exports them
+    for everyone.
+    """
+
+    def __init__(self, shard, settings):
+        self.shard = shard
+        self.settings = settings
+        self.shared = SharedArrays.attach(settings["shared"])
+        super().__init__()
+
+        self.canvas_layout = settings["layout"]
+        reports = settings["reports"]
+        self.tokens = ShardTokens(
+            reports,
+            self.http,
+            self.token_url,
+            self.json_data["workers"],
+            None,
+            self.json_data.get("token_refresh_margin", 300),
+            self.json_data.get("token_refresh_interval", 1),
+        )
+        for name, (token, expires_at) in settings["tokens"].items():
+            self.tokens.store(name, token, expires_at)
+        self.next_pixel_placement_time = ShardCooldowns(reports, settings["cooldowns"])
+        self.placement_verifier = ShardVerifier(reports)
+
+    def get_json_data(self):
+        return self.settings["json_data"]
+
+    def load_templates(self):
+        targets = [
+            shared_target(self, description, self.shared.group(f"{number}/"))
+            for number, description in enumerate(self.settings["targets"])
+        ]
+        return targets, self.settings["region"]
+
+    # The coordinator keeps the shared indexes up to date
+    def update_board(self, access_token_in):
+        pass
+
+    # Apply messages from the coordinator
+    def listen(self):
+        while True:
+            kind, data = self.settings["inbox"].get()
+            if kind == "layout":
+                self.canvas_layout = data
+
+    def send_metrics(self):
+        while True:
+            time.sleep(METRICS_INTERVAL)
+            self.settings["reports"].put(("metrics", self.shard, metrics.to_dict()))
+
+    # Don't outlive the coordinator, however it exits
+    def watch_coordinator(self):
+        multiprocessing.parent_process().join()
+        logging.error("Coordinator exited, stopping")
+        os._exit(1)
+
+    def start(self):
+        threading.Thread(target=self.watch_coordinator, daemon=True).start()
+        threading.Thread(target=self.listen, daemon=True).start()
+        threading.Thread(target=self.send_metrics, daemon=True).start()
+        self.scheduler = Scheduler(self.scheduler_threads)
+        self.update_workers()
+        self.scheduler.run()
+
+
+def run_shard(shard, settings):
+    # Ctrl+C reaches every process, leave stopping the shards to the coordinator
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Spawned processes start with logging unconfigured
+    logging.basicConfig(
+        level=settings["loglevel"],
+        format=f"[%(asctime)s] :: [shard {shard}] [%(levelname)s] - %(message)s",
+        datefmt="%d-%b-%y %H:%M:%S",
+    )
+    ShardClient(shard, settings).start()
+
+
+class Coordinator:
+    """Runs the workers of a PlaceClient sharded across several processes.
+
+    Everything in one process contends for one core, which limits how many
+    accounts it can drive. The coordinator is the only one keeping the board,
+    fetched or subscribed to as usual, and applies it to templates and
+    mismatch indexes in shared memory. Every shard process reads them without
+    a copy of its own and leases pixels from shared leases, so shards never
+    place the same pixel. Config reloads need a restart in this mode.
+    """
+
+    def __init__(self, client, processes, loglevel=logging.INFO):
+        self.client = client
+        self.processes = min(processes, len(client.json_data["workers"]))
+        self.loglevel = loglevel
+        # Forking a process with running threads isn't safe
+        self.context = multiprocessing.get_context("spawn")
+        self.reports = self.context.Queue()
+        self.shared = None
+        # Picklable descriptions of the shared targets, in order
+        self.descriptions = []
+        # Shard number -> (process, inbox)
+        self.shards = {}
+        self.layout = None
+
+    def share_targets(self):
+        """Move the client's targets into shared memory."""
+        client = self.client
+        shapes = {}
+        for number, target in enumerate(client.targets):
+            prefix = f"{number}/"
+            shapes[prefix + "pixels"] = (target.template.pixels.shape, np.uint8)
+            for key, shape in index_arrays(target.template).items():
+                shapes[prefix + key] = shape
+            shapes[prefix + "leases"] = ((target.template.pixels.size,), np.float64)
+            shapes[prefix + "overwrites"] = (
+                (2, *target.template.pixels.shape),
+                np.float64,
+            )
+        self.shared = SharedArrays.create(shapes)
+
+        configs = {
+            config.get("name", config["image_path"]): config
+            for config in client.template_configs()
+        }
+        targets = []
+        for number, target in enumerate(client.targets):
+            arrays = self.shared.group(f"{number}/")
+            arrays["pixels"][:] = target.template.pixels
+            description = {
+                "name": target.name,
+                "origin": target.origin,
+                "priority": target.priority,
+                "workers": target.workers,
+                "config": configs[target.name],
+                "locks": (self.context.Lock(), self.context.Lock()),
+            }
+            self.descriptions.append(description)
+            targets.append(shared_target(client, description, arrays))
+        client.targets = targets
+
+    def access_token(self):
+        return self.client.tokens.get(next(iter(self.client.json_data["workers"])))
+
+    def start_shard(self, shard):
+        client = self.client
+        workers = client.json_data["workers"]
+        names = list(workers)[shard :: self.processes]
+        json_data = dict(client.json_data)
+        json_data["workers"] = {name: workers[name] for name in names}
+        # The coordinator exports metrics and sees the board for everyone
+        json_data.pop("metrics_port", None)
+        json_data.pop("metrics_file", None)
+        json_data.pop("history_dir", None)
+        # Token requests are spaced out per process, keep the overall rate
+        json_data["token_refresh_interval"] = (
+            client.json_data.get("token_refresh_interval", 1) * self.processes
+        )
+
+        tokens = client.tokens.export()
+        inbox = self.context.Queue()
+        settings = {
+            "json_data": json_data,
+            "shared": self.shared.spec,
+            "targets": self.descriptions,
+            "region": client.region,
+            "layout": self.layout,
+            "tokens": {name: tokens[name] for name in names if name in tokens},
+            "cooldowns": {
+                name: client.next_pixel_placement_time.get(name)
+                for name in names
+                if client.next_pixel_placement_time.get(name) is not None
+            },
+            "reports": self.reports,
+            "inbox": inbox,
+            "loglevel": self.loglevel,
+        }
+        process = self.context.Process(
+            target=run_shard, name=f"shard-{shard}", args=(shard, settings), daemon=True
+        )
+        process.start()
+        self.shards[shard] = (process, inbox)
+        logging.info(f"Started shard {shard} with {len(names)} workers")
+
+    def handle(self, report):
+        kind, *data = report
+        if kind == "cooldown":
+            self.client.next_pixel_placement_time.set(*data)
+        elif kind == "token":
+            self.client.tokens.store(*data)
+        elif kind == "metrics":
+            shard, snapshot = data
+            metrics.update_from(snapshot, shard=shard)
+        elif kind == "placed":
+            name, *placement = data
+            for target in self.client.targets:
+                if target.name == name:
+                    self.client.placement_verifier.add(target, *placement)
+                    break
+
+    def update(self):
+        client = self.client
+        client.update_board(self.access_token())
+        for target in client.targets:
+            client.record_progress(target)
+
+        if client.canvas_layout != self.layout:
+            self.layout = client.canvas_layout
+            for _, inbox in self.shards.values():
+                inbox.put(("layout", self.layout))
+
+        for shard, (process, _) in list(self.shards.items()):
+            if not process.is_alive():
+                logging.error(
+                    f"Shard {shard} exited with code {process.exitcode}, restarting it"
+                )
+                self.start_shard(shard)
+
+    def run(self):
+        # Stop the shards and free the shared memory when killed too
+        signal.signal(signal.SIGTERM, lambda *_: exit(0))
+        self.share_targets()
+        # Shards only read the board, have it before starting them
+        self.client.update_board(self.access_token())
+        self.layout = self.client.canvas_layout
+        for shard in range(self.processes):
+            self.start_shard(shard)
+
+        try:
+            next_update = time.time()
+            while True:
+                try:
+                    self.handle(self.reports.get(timeout=1))
+                except queue.Empty:
+                    pass
+                if time.time() >= next_update:
+                    self.update()
+                    next_update = time.time() + self.client.board_max_age
+        finally:
+            for process, _ in self.shards.values():
+                process.terminate()
+            self.shared.close()
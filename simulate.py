@@ -0,0 +1,344 @@
+import bisect
+import heapq
+import itertools
+
+import numpy as np
+
+from priority import Prioritizer
+from targets import Target
+from template import TRANSPARENT
+
+# Seconds between two placements of an account, with some margin over
+# reddit's 5 minutes, or 20 minutes for unverified accounts
+VERIFIED_COOLDOWN = 330
+UNVERIFIED_COOLDOWN = 1230
+
+# Color of an untouched canvas
+BLANK_RGB = (255, 255, 255)
+
+# Event kinds, damage sorts first when both happen at the same moment
+DAMAGE = 0
+PLACE = 1
+
+# Damage drawn from the random generator at once
+DRAWS = 4096
+
+# Priority orders are kept until placements fixed 1/REORDER_SHARE of them
+REORDER_SHARE = 64
+
+
+class Simulation:
+    """Discrete-event simulation of accounts drawing the client's templates.
+
+    Nothing is sent anywhere. The board starts out blank, accounts place a
+    pixel every cooldown seconds, their first placements staggered by
+    thread_delay, and pick pixels through the same planners and priority
+    strategies as real workers. Meanwhile griefers paint random template
+    pixels in random colors, damage_rate pixels per minute on average.
+    Placements always succeed and show up on the board right away.
+
+    Time jumps from one event to the next, and accounts with nothing to do
+    sleep until there's damage to fix, so simulating idle hours is free.
+    """
+
+    def __init__(self, client, accounts, cooldown, damage_rate, seed=0):
+        # (worker name, worker config) per simulated account
+        self.accounts = accounts
+        self.cooldown = cooldown
+        self.damage_rate = damage_rate
+        self.thread_delay = client.delay_between_launches
+        self.recheck_delay = client.completed_recheck_delay
+        self.board_max_age = client.board_max_age
+        self.rng = np.random.default_rng(seed)
+        self.colors = np.array(client.palette.indices, dtype=np.uint8)
+
+        # Fresh targets, so every simulation starts from scratch
+        self.targets = []
+        blank = client.palette.closest_index(BLANK_RGB)
+        for target in client.targets:
+            prioritizer = target.prioritizer
+            simulated = Target(
+                target.name,
+                target.template,
+                target.origin,
+                Prioritizer(
+                    prioritizer.strategy,
+                    target.template,
+                    client.palette,
+                    prioritizer.mask,
+                ),
+                target.priority,
+                target.workers,
+            )
+            simulated.index.update(
+                0, 0, np.full(target.template.pixels.shape, blank, dtype=np.uint8)
+            )
+            self.targets.append(simulated)
+        # Index version, time on the simulated clock and placement count the
+        # priority order of every target was computed at
+        self._ordered = [(None, float("-inf"), 0)] * len(self.targets)
+
+        # Every template pixel griefers can hit, as target numbers and flat
+        # template indices. Compositing left no overlaps.
+        owners, pixels = [], []
+        for number, target in enumerate(self.targets):
+            opaque = np.flatnonzero(target.template.pixels != TRANSPARENT)
+            owners.append(np.full(len(opaque), number))
+            pixels.append(opaque)
+        self._owners = np.concatenate(owners)
+        self._pixels = np.concatenate(pixels)
+        self.pixel_count = len(self._pixels)
+
+        self.wrong = sum(target.index.count for target in self.targets)
+        self.placements = 0
+        self.damaged = 0
+        self.cursors = {}
+        # (time % recheck_delay, account) of accounts that found nothing to
+        # do. They'd check again every recheck_delay seconds.
+        self._idle = []
+        self._events = []
+        # (interval, pixel, color) of upcoming damage, last first
+        self._damage_draws = []
+        self._sequence = itertools.count()
+
+    def run(self, hours, target_accuracy=0.99):
+        """Simulate hours of drawing, returns a dict of results.
+
+        completed_at and accurate_at are the first moments, in seconds, all
+        pixels or target_accuracy of them were right, None if that never
+        happened. steady_accuracy is the average share of right pixels over
+        the second half of the run.
+        """
+        end = hours * 3600
+        steady_start = end / 2
+        steady_wrong = 0.0
+        completed_at = accurate_at = None
+        last = 0.0
+
+        for account in range(len(self.accounts)):
+            self._push(account * self.thread_delay, PLACE, account)
+        if self.damage_rate > 0:
+            self._schedule_damage(0)
+
+        while self._events:
+            now, kind, _, data = heapq.heappop(self._events)
+            if now > end:
+                break
+            if now > steady_start:
+                steady_wrong += self.wrong * (now - max(last, steady_start))
+            last = now
+
+            if kind == DAMAGE:
+                self._damage(now, *data)
+                self._schedule_damage(now)
+            else:
+                next_time = self._place(data, now)
+                if next_time is not None:
+                    self._push(next_time, PLACE, data)
+
+            if completed_at is None and self.wrong == 0:
+                completed_at = now
+            if accurate_at is None and self.accuracy >= target_accuracy:
+                accurate_at = now
+
+        steady_wrong += self.wrong * (end - max(last, steady_start))
+        possible = sum(
+            int((end - start) // self.cooldown) + 1
+            for start in np.arange(len(self.accounts)) * self.thread_delay
+            if start <= end
+        )
+        return {
+            "accounts": len(self.accounts),
+            "completed_at": completed_at,
+            "accurate_at": accurate_at,
+            "steady_accuracy": (
+                1 - steady_wrong / (end - steady_start) / self.pixel_count
+                if self.pixel_count
+                else 1.0
+            ),
+            "placements": self.placements,
+            "damaged": self.damaged,
+            # Share of the cooldowns actually used to place a pixel
+            "utilization": self.placements / possible if possible else 0.0,
+        }
+
+    @property
+    def accuracy(self):
+        return 1 - self.wrong / self.pixel_count if self.pixel_count else 1.0
+
+    def _push(self, time, kind, data):
+        # data is the account placing or the pixel and color of damage
+        heapq.heappush(self._events, (time, kind, next(self._sequence), data))
+
+    def _schedule_damage(self, now):
+        if not self._damage_draws:
+            # Drawing random numbers one at a time is slow, draw ahead
+            self._damage_draws = list(
+                zip(
+                    self.rng.exponential(60 / self.damage_rate, DRAWS).tolist(),
+                    self.rng.integers(self.pixel_count, size=DRAWS).tolist(),
+                    self.rng.choice(self.colors, DRAWS).tolist(),
+                )
+            )
+            self._damage_draws.reverse()
+        interval, choice, color = self._damage_draws.pop()
+        self._push(now + interval, DAMAGE, (choice, color))
+
+    def _set(self, target, pixel, color):
+        before = target.index.count
+        target.index.mark(pixel, color)
+        self.wrong += target.index.count - before
+        return target.index.count > before
+
+    def _damage(self, now, choice, color):
+        target = self.targets[self._owners[choice]]
+        self.damaged += 1
+        if self._set(target, int(self._pixels[choice]), color):
+            self._wake(target, now)
+
+    def _place(self, account, now):
+        # Same as PlaceClient.get_unset_pixel, returns when to place next
+        name, worker = self.accounts[account]
+        for number, target in enumerate(self.targets):
+            if not target.allows(name):
+                continue
+            self._update_priority(number, now)
+
+            x, y = self.cursors.get((account, number), worker["start_coords"])
+            width = target.template.size[0]
+            pixel = target.planner.acquire(y * width + x)
+            if pixel is None:
+                continue
+            y, x = divmod(pixel, width)
+            self.cursors[account, number] = x, y
+            self._set(target, pixel, int(target.template.pixels[y, x]))
+            # The board shows it right away, no need to keep it leased
+            target.planner.release(pixel, False)
+            self.placements += 1
+            return now + self.cooldown
+
+        bisect.insort(self._idle, (now % self.recheck_delay, account))
+        return None
+
+    def _update_priority(self, number, now):
+        # Like Target.update_priority, on the simulated clock. Sorting every
+        # wrong pixel for every placement would make simulating big templates
+        # slow, so an order is also kept until placements fixed
+        # 1/REORDER_SHARE of the pixels in it. How stale the tail of a long
+        # queue is hardly matters.
+        target = self.targets[number]
+        version, ordered_at, placements = self._ordered[number]
+        if (
+            target.prioritizer.strategy == "raster"
+            or target.index.version == version
+            or now - ordered_at < self.board_max_age
+            or self.placements - placements < target.index.count // REORDER_SHARE
+        ):
+            return
+        self._ordered[number] = (target.index.version, now, self.placements)
+        mismatches = target.index.mismatches()
+        scores = target.prioritizer.score(target.index.board, mismatches, now)
+        target.planner.update(mismatches, scores)
+
+    def _wake(self, target, now):
+        # Of the idle accounts allowed to fix it, the one checking next would
+        # find the damage. The others would find nothing, let them sleep.
+        phase = now % self.recheck_delay
+        start = bisect.bisect_left(self._idle, (phase, -1))
+        for offset in range(len(self._idle)):
+            position = (start + offset) % len(self._idle)
+            account_phase, account = self._idle[position]
+            if not target.allows(self.accounts[account][0]):
+                continue
+            del self._idle[position]
+            wake_at = now - phase + account_phase
+            if wake_at < now:
+                wake_at += self.recheck_delay
+            self._push(wake_at, PLACE, account)
+            return
+
+
+def simulated_accounts(workers, count):
+    """count accounts, taking turns copying the configured workers."""
+    names = list(workers)
+    return [
+        (names[number % len(names)], workers[names[number % len(names)]])
+        for number in range(count)
+    ]
+
+
+def accounts_needed(
+    client, cooldown, damage_rate, hours, target_accuracy, seed=0, limit=1 << 16
+):
+    """Fewest accounts keeping steady_accuracy at target_accuracy, None above limit."""
+
+    def enough(count):
+        simulation = Simulation(
+            client,
+            simulated_accounts(client.json_data["workers"], count),
+            cooldown,
+            damage_rate,
+            seed,
+        )
+        return simulation.run(hours, target_accuracy)["steady_accuracy"] >= (
+            target_accuracy
+        )
+
+    # Fewer can't even keep up with the damage to right pixels, start there,
+    # double until it's enough, then bisect
+    colors = len(client.palette.indices)
+    low = int(damage_rate / 60 * cooldown * target_accuracy * (colors - 1) / colors)
+    high = max(low, 1)
+    while not enough(high):
+        if high >= limit:
+            return None
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if enough(middle):
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "never"
+    hours, seconds = divmod(int(seconds), 3600)
+    return f"{hours}h{seconds // 60:02d}m"
+
+
+def simulate(client, damage_rate, hours=24, target_accuracy=0.99, seed=0):
+    """Simulate the client's config and print what to expect."""
+    cooldown = (
+        UNVERIFIED_COOLDOWN if client.unverified_place_frequency else VERIFIED_COOLDOWN
+    )
+    workers = client.json_data["workers"]
+    simulation = Simulation(
+        client, simulated_accounts(workers, len(workers)), cooldown, damage_rate, seed
+    )
+    results = simulation.run(hours, target_accuracy)
+    needed = accounts_needed(
+        client, cooldown, damage_rate, hours, target_accuracy, seed
+    )
+
+    print(f"pixels                   {simulation.pixel_count}")
+    print(f"accounts                 {results['accounts']}")
+    print(f"cooldown                 {cooldown}s")
+    print(f"damage_rate              {damage_rate}/min")
+    print(f"simulated                {hours}h")
+    print(f"completed_at             {format_duration(results['completed_at'])}")
+    print(
+        f"accurate_at              {format_duration(results['accurate_at'])}"
+        f" ({target_accuracy:.1%} right)"
+    )
+    print(f"steady_accuracy          {results['steady_accuracy']:.2%}")
+    print(f"placements               {results['placements']}")
+    print(f"damaged                  {results['damaged']}")
+    print(f"utilization              {results['utilization']:.1%}")
+    print(
+        f"accounts_needed          {needed if needed is not None else 'more than 65536'}"
+        f" (for {target_accuracy:.1%} steady accuracy)"
+    )
+    return results, needed
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import numpy as np
+
+from diff import MismatchIndex
+from planner import PlacementPlanner
+
+
+class Target:
+    """One template from the config, with everything needed to draw it.
+
+    template only holds the pixels this target owns after compositing, the
+    ones covered by higher priority templates are transparent. workers is
+    the set of worker names allowed to draw it, None meaning all of them.
+    index and planner can be passed in when they're shared with other
+    processes.
+    """
+
+    def __init__(
+        self,
+        name,
+        template,
+        origin,
+        prioritizer,
+        priority=0,
+        workers=None,
+        lease_time=60,
+        index=None,
+        planner=None,
+    ):
+        self.name = name
+        self.template = template
+        self.origin = origin
+        self.prioritizer = prioritizer
+        self.priority = priority
+        self.workers = workers
+
+        # Wrong pixels, kept up to date from board frames and our own placements
+        self.index = MismatchIndex(template) if index is None else index
+        # Hands out wrong pixels so workers don't place the same one
+        if planner is None:
+            planner = PlacementPlanner(self.index, lease_time)
+        self.planner = planner
+
+        # Index version the priority order was computed for, and when
+        self._ordered_version = None
+        self._ordered_at = float("-inf")
+        self._lock = threading.Lock()
+
+    @property
+    def region(self):
+        """Board rectangle covered by the template, as (x, y, width, height)."""
+        return (*self.origin, *self.template.size)
+
+    def allows(self, worker_name):
+        return self.workers is None or worker_name in self.workers
+
+    def apply_frame(self, offset, frame, mask=None):
+        """Apply the part of a board frame at offset covering the template.
+
+        frame is an array of palette indices, mask optionally marks which of
+        its pixels are set.
+        """
+        x, y, width, height = self.region
+        left = max(x - offset[0], 0)
+        top = max(y - offset[1], 0)
+        right = min(x + width - offset[0], frame.shape[1])
+        bottom = min(y + height - offset[1], frame.shape[0])
+        if left >= right or top >= bottom:
+            return
+
+        area = np.s_[top:bottom, left:right]
+        self.index.update(
+            offset[0] + left - x,
+            offset[1] + top - y,
+            frame[area],
+            None if mask is None else mask[area],
+        )
+
+    def update_priority(self, max_age):
+        """Recompute the order wrong pixels are handed out in.
+
+        That's a pass over all of them, so it's done at most every max_age
+        seconds, and only if something changed.
+        """
+        with self._lock:
+            if (
+                self.index.version == self._ordered_version
+                or time.monotonic() - self._ordered_at < max_age
+            ):
+                return
+            self._ordered_version = self.index.version
+            self._ordered_at = time.monotonic()
+            # Raster order needs no scores, unless lost pixels are deferred
+            if (
+                self.prioritizer.strategy == "raster"
+                and not self.prioritizer.overwrites[0].any()
+            ):
+                self.planner.prune()
+                return
+            mismatches = self.index.mismatches()
+            scores = self.prioritizer.score(self.index.board, mismatches, time.time())
+            self.planner.update(mismatches, scores)
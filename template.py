@@ -0,0 +1,144 @@
+import functools
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from dither import DITHERING
+from files import atomic_write
+from palette import MATCHING
+
+# Palette index used for template pixels that should be left alone.
+# r/place color indices never go above 31, so this can't clash with one.
+TRANSPARENT = 0xFF
+
+# Source color that marks a transparent pixel in the template image
+TRANSPARENT_RGB = (69, 42, 0)
+
+# Bump when the layout of cached templates changes
+CACHE_VERSION = 1
+
+
+class Template:
+    """A template image converted to a (height, width) array of palette indices."""
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+    @property
+    def size(self):
+        height, width = self.pixels.shape
+        return width, height
+
+    @functools.cached_property
+    def pixel_count(self):
+        """Number of pixels that are actually drawn, counted once."""
+        return int(np.count_nonzero(self.pixels != TRANSPARENT))
+
+    @classmethod
+    def from_image(cls, im, palette, matching="rgb", dithering=None):
+        """Quantize an image, see MATCHING and DITHERING for the options."""
+        rgba = np.asarray(im.convert("RGBA"))
+        transparent = (rgba[..., 3] == 0) | np.all(
+            rgba[..., :3] == TRANSPARENT_RGB, axis=2
+        )
+
+        if dithering is None:
+            pixels = palette.quantize(rgba[..., :3], matching)
+        else:
+            pixels = DITHERING[dithering](
+                rgba[..., :3], palette, matching, opaque=~transparent
+            )
+        pixels[transparent] = TRANSPARENT
+
+        return cls(pixels)
+
+    @classmethod
+    def load(cls, image_path, palette, cache_dir=None, matching="rgb", dithering=None):
+        """Load a template, reusing the quantized copy in cache_dir if present.
+
+        The cache is keyed by the image contents, the palette and the
+        quantization options, so changing any of them transparently
+        invalidates it.
+        """
+        if matching not in MATCHING:
+            raise ValueError(
+                f"Unknown color matching {matching!r}, use one of {', '.join(MATCHING)}"
+            )
+        if dithering is not None and dithering not in DITHERING:
+            raise ValueError(
+                f"Unknown dithering {dithering!r}, use one of {', '.join(DITHERING)}"
+            )
+
+        with open(image_path, "rb") as f:
+            image_data = f.read()
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(
+                cache_dir,
+                f"template-{cache_key(image_data, palette, matching, dithering)}.npy",
+            )
+            try:
+                pixels = np.load(cache_path, allow_pickle=False)
+            except (OSError, ValueError):
+                pass
+            else:
+                logging.info(f"Loaded quantized template from {cache_path}")
+                return cls(pixels)
+
+        # Let PIL raise UnidentifiedImageError for the caller to report
+        with Image.open(BytesIO(image_data)) as im:
+            template = cls.from_image(im, palette, matching, dithering)
+
+        if cache_path is not None:
+            template.save(cache_path)
+
+        return template
+
+    def save(self, path):
+        with atomic_write(path, "wb") as f:
+            np.save(f, self.pixels, allow_pickle=False)
+
+
+def composite(layers):
+    """Composite (template, origin, priority) layers into one target map.
+
+    Opaque pixels of higher priority layers cover lower ones, equal
+    priorities are resolved in favour of the earlier layer. Returns the
+    composite Template, its origin on the board and the number of the layer
+    owning each of its pixels, -1 where every layer is transparent.
+    """
+    left = min(x for _, (x, _), _ in layers)
+    top = min(y for _, (_, y), _ in layers)
+    right = max(x + template.size[0] for template, (x, _), _ in layers)
+    bottom = max(y + template.size[1] for template, (_, y), _ in layers)
+
+    pixels = np.full((bottom - top, right - left), TRANSPARENT, dtype=np.uint8)
+    owners = np.full(pixels.shape, -1, dtype=np.int16)
+    # Paint the lowest priority first, so higher ones end up on top
+    order = sorted(range(len(layers)), key=lambda number: (layers[number][2], -number))
+    for number in order:
+        template, (x, y), _ = layers[number]
+        width, height = template.size
+        area = np.s_[y - top : y - top + height, x - left : x - left + width]
+        opaque = template.pixels != TRANSPARENT
+        pixels[area][opaque] = template.pixels[opaque]
+        owners[area][opaque] = number
+
+    return Template(pixels), (left, top), owners
+
+
+def cache_key(image_data, palette, matching="rgb", dithering=None):
+    digest = hashlib.sha256()
+    digest.update(f"v{CACHE_VERSION}".encode())
+    for index, rgb in palette.index_to_rgb.items():
+        digest.update(bytes((index, *rgb)))
+    # Only hashed when set, so caches from before these options stay valid
+    if matching != "rgb" or dithering is not None:
+        digest.update(f"{matching}/{dithering}".encode())
+    digest.update(image_data)
+    return digest.hexdigest()
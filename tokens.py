@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from requests.auth import HTTPBasicAuth
+
+from files import atomic_write
+from metrics import metrics
+
+
+class TokenManager:
+    """Keeps an access token for every worker, refreshing them ahead of expiry.
+
+    Tokens are cached in cache_path together with their expiry, so a restart
+    reuses every token that's still valid. Refreshes are serialized and
+    spaced at least refresh_interval seconds apart, so hundreds of accounts
+    don't all hit the token endpoint at once.
+    """
+
+    def __init__(
+        self,
+        http,
+        token_url,
+        workers,
+        cache_path=None,
+        refresh_margin=300,
+        refresh_interval=1,
+    ):
+        self.http = http
+        self.token_url = token_url
+        self.workers = workers
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+
+        # Worker name -> (access token, expiry timestamp)
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._last_refresh = 0
+
+        self.refreshes = 0
+        self.load_cache()
+
+    def load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable token cache {self.cache_path}: {e}")
+            return
+
+        now = time.time()
+        for name, (token, expires_at) in cached.items():
+            if name in self.workers and expires_at > now:
+                self._tokens[name] = (token, expires_at)
+        logging.info(f"Reusing {len(self._tokens)} cached access tokens")
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        # Saved one at a time, so an older copy never replaces a newer one
+        with self._save_lock:
+            with self._lock:
+                tokens = dict(self._tokens)
+
+            # Tokens are credentials, keep them private to the user
+            with atomic_write(self.cache_path, permissions=0o600) as f:
+                json.dump(tokens, f)
+
+    def get(self, name):
+        """Return a valid token for a worker, refreshing it first if needed."""
+        with self._lock:
+            token, expires_at = self._tokens.get(name, (None, 0))
+        if token is not None and expires_at > time.time():
+            return token
+        return self.refresh(name)
+
+    def any_token(self):
+        """Return the valid token that expires last, refreshing one if none is."""
+        with self._lock:
+            token, expires_at = max(
+                self._tokens.values(), key=lambda cached: cached[1], default=(None, 0)
+            )
+        if expires_at > time.time():
+            return token
+        return self.get(next(iter(self.workers)))
+
+    def update_workers(self, workers):
+        """Switch to a new set of workers, forgetting the removed ones' tokens."""
+        with self._lock:
+            self.workers = workers
+            for name in list(self._tokens):
+                if name not in workers:
+                    del self._tokens[name]
+        self.save_cache()
+
+    def refresh_at(self, name):
+        """Timestamp at which a worker's token should be refreshed."""
+        with self._lock:
+            if name not in self._tokens:
+                return time.time()
+            _, expires_at = self._tokens[name]
+        return expires_at - self.refresh_margin
+
+    def refresh(self, name):
+        with self._refresh_lock:
+            # Someone else may have refreshed it while we waited
+            with self._lock:
+                token, expires_at = self._tokens.get(name, (None, 0))
+            if token is not None and expires_at - self.refresh_margin > time.time():
+                return token
+
+            wait = self._last_refresh + self.refresh_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                token, expires_at = self.request_token(name)
+            finally:
+                self._last_refresh = time.monotonic()
+
+        self.refreshes += 1
+        metrics.inc("token_refreshes_total", account=name)
+        self.store(name, token, expires_at)
+        return token
+
+    def store(self, name, token, expires_at):
+        """Keep a worker's token, also used for tokens refreshed elsewhere."""
+        with self._lock:
+            self._tokens[name] = (token, expires_at)
+        self.save_cache()
+
+    def export(self):
+        """All tokens, as worker name -> (access token, expiry timestamp)."""
+        with self._lock:
+            return dict(self._tokens)
+
+    def request_token(self, name):
+        logging.info(f"{name} :: Refreshing access token")
+        worker = self.workers[name]
+
+        # developer's reddit username and password
+        try:
+            username = name
+            password = worker["password"]
+            # note: use https://www.reddit.com/prefs/apps
+            app_client_id = worker["client_id"]
+            secret_key = worker["client_secret"]
+        except Exception:
+            print(
+                f"You need to provide all required fields to worker '{name}'",
+            )
+            exit(1)
+
+        data = {
+            "grant_type": "password",
+            "username": username,
+            "password": password,
+        }
+
+        current_timestamp = time.time()
+        r = self.http.post(
+            self.token_url,
+            "token",
+            data=data,
+            auth=HTTPBasicAuth(app_client_id, secret_key),
+            headers={"User-agent": f"placebot{random.randint(1, 100000)}"},
+        )
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Received response: %s", r.text)
+
+        response_data = r.json()
+
+        if "error" in response_data:
+            print(
+                f"An error occured. Make sure you have the correct credentials. Response data: {response_data}"
+            )
+            exit(1)
+
+        access_token = response_data["access_token"]
+        # access_token_type = response_data["token_type"]  # this is just "bearer"
+        access_token_expires_in_seconds = response_data[
+            "expires_in"
+        ]  # this is usually "3600"
+        # access_token_scope = response_data["scope"]  # this is usually "*"
+
+        logging.info(f"Received new access token: {access_token[:5]}************")
+
+        return access_token, current_timestamp + int(access_token_expires_in_seconds)
+
+    def refresh_job(self, name):
+        """Scheduler job refreshing a worker's token ahead of its expiry."""
+        if name not in self.workers:
+            # Removed from the config
+            return None
+        self.refresh(name)
+        return self.refresh_at(name)
@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from metrics import metrics
+
+# Ways a placement can end up
+RESULTS = ("held", "overwritten", "unconfirmed")
+
+
+class PlacementVerifier:
+    """Checks whether the pixels we place show up on the board and stay there.
+
+    A placement is confirmed once a board frame shows its color, and
+    overwritten when a later frame shows another one. It's held if it's
+    still ours hold_time seconds after placing, and unconfirmed if no frame
+    showed it within timeout seconds, which also covers board snapshots
+    older than the placement. Overwritten and unconfirmed pixels are
+    reported to their target's prioritizer, so pixels we can't hold get
+    fixed after the ones we can. The target's planner stops holding a
+    placed pixel once a frame shows it, whatever its color.
+    """
+
+    def __init__(self, hold_time=300, timeout=60):
+        self.hold_time = hold_time
+        self.timeout = timeout
+        # Board (x, y) ->
+        # [target, pixel, color, account, placed_at, confirmed, seen]
+        self._pending = {}
+        # Account -> result -> count
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def add(self, target, pixel, color, account, placed_at=None):
+        """Track a placement of a color at a flat template index of target."""
+        if placed_at is None:
+            placed_at = time.time()
+        y, x = divmod(pixel, target.template.size[0])
+        position = (target.origin[0] + x, target.origin[1] + y)
+        with self._lock:
+            previous = self._pending.get(position)
+            if previous is not None:
+                # Placed again before a frame showed what became of it, the
+                # lease is the new placement's now
+                previous[6] = True
+                self._finish(position, "unconfirmed", placed_at)
+            placement = [target, pixel, color, account, placed_at, False, False]
+            self._pending[position] = placement
+
+    def observe(self, offset, frame, mask=None, now=None):
+        """Check the tracked placements against a board frame at offset.
+
+        frame is an array of palette indices, mask optionally marks which of
+        its pixels are set.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not self._pending:
+                return
+            positions = np.array(list(self._pending), dtype=np.int64)
+            xs = positions[:, 0] - offset[0]
+            ys = positions[:, 1] - offset[1]
+            height, width = frame.shape
+            inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+            if mask is not None:
+                inside[inside] = mask[ys[inside], xs[inside]]
+
+            for (x, y), value in zip(
+                positions[inside].tolist(), frame[ys[inside], xs[inside]].tolist()
+            ):
+                placement = self._pending[x, y]
+                if not placement[6]:
+                    # Right or griefed already, the board caught up with it
+                    placement[6] = True
+                    placement[0].planner.settle(placement[1])
+                if value == placement[2]:
+                    placement[5] = True
+                elif placement[5]:
+                    self._finish((x, y), "overwritten", now)
+
+            self._expire(now)
+
+    def _expire(self, now):
+        for position, placement in list(self._pending.items()):
+            age = now - placement[4]
+            if placement[5] and age >= self.hold_time:
+                self._finish(position, "held", now)
+            elif not placement[5] and age >= self.timeout:
+                self._finish(position, "unconfirmed", now)
+
+    def _finish(self, position, result, now):
+        target, pixel, _, account, placed_at, _, seen = self._pending.pop(position)
+        if not seen:
+            target.planner.settle(pixel)
+        counts = self.results.setdefault(account, dict.fromkeys(RESULTS, 0))
+        counts[result] += 1
+        metrics.inc("placements_verified_total", account=account, result=result)
+        metrics.set(
+            "account_effective_success_ratio",
+            counts["held"] / sum(counts.values()),
+            account=account,
+        )
+
+        if result == "held":
+            return
+        if result == "overwritten":
+            metrics.observe(
+                "pixel_survival_seconds", now - placed_at, template=target.name
+            )
+            logging.debug(
+                "%s :: pixel at %s overwritten after %.0fs",
+                account,
+                position,
+                now - placed_at,
+            )
+        y, x = divmod(pixel, target.template.size[0])
+        target.prioritizer.record_overwrite(y, x, now)